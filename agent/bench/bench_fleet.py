@@ -0,0 +1,389 @@
+"""
+Fleet load test
+Runs a stand-in server speaking the agent protocol (hello, delta_ack,
+execute/result/result_ack, heartbeat) and connects many RemoteAgent
+instances to it from one or more worker processes. Reports command
+round-trip percentiles, heartbeat throughput, per-agent memory and CPU,
+and time-to-connected.
+
+Telemetry and inventory collectors are replaced by seeded stubs so runs
+are repeatable; --stub-commands also replaces command execution.
+
+Usage: python bench/bench_fleet.py [--agents N] [--processes N] [--rounds N]
+                                   [--command CMD] [--stub-commands]
+                                   [--heartbeat-interval S] [--duration S]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+import psutil  # noqa: E402
+import websockets  # noqa: E402
+
+from delta import apply_patch  # noqa: E402
+from wire import WireCodec  # noqa: E402
+
+TOKEN = 'bench-token'
+# Same mapping as DELTA_STREAMS in server/src/index.js
+DELTA_STREAMS = {'heartbeat': 'heartbeat', 'agent_info': 'system_info', 'system_info': 'system_info'}
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def summarize(values, unit='ms', scale=1000):
+    if not values:
+        return 'n/a'
+    return (
+        f"p50 {percentile(values, 0.5) * scale:.1f}{unit}  "
+        f"p95 {percentile(values, 0.95) * scale:.1f}{unit}  "
+        f"p99 {percentile(values, 0.99) * scale:.1f}{unit}  "
+        f"max {max(values) * scale:.1f}{unit}"
+    )
+
+
+class StandInServer:
+    """Just enough of server/src/index.js to keep agents busy"""
+
+    def __init__(self, encoding='json', compression='zlib'):
+        self.encoding = encoding
+        self.compression = compression
+        self.connections = {}  # agentId -> websocket
+        self.connected = asyncio.Event()
+        self.expected = 0
+        self.pending = {}  # commandId -> future resolved by the result
+        self.heartbeats = 0
+        self.messages = 0
+        self.bytes_received = 0
+        self.resyncs = 0
+
+    async def handler(self, ws, path=None):
+        headers = ws.request_headers
+        if headers.get('X-Agent-Token') != TOKEN:
+            await ws.close(1008, 'Invalid token')
+            return
+
+        agent_id = headers.get('X-Agent-Id')
+        if headers.get('X-Agent-Encodings'):
+            await ws.send(json.dumps({
+                'type': 'hello',
+                'encoding': self.encoding,
+                'compression': self.compression,
+                'resultAck': True
+            }))
+
+        self.connections[agent_id] = ws
+        if len(self.connections) >= self.expected:
+            self.connected.set()
+
+        codec = WireCodec()
+        snapshots = {}  # stream -> (version, data), like DeltaTracker
+        try:
+            async for frame in ws:
+                self.messages += 1
+                self.bytes_received += len(frame)
+                await self.on_message(ws, codec.decode(frame), snapshots)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            if self.connections.get(agent_id) is ws:
+                del self.connections[agent_id]
+
+    async def on_message(self, ws, message, snapshots):
+        if message['type'] == 'delta':
+            current = snapshots.get(message['stream'])
+            if current is None or current[0] != message['base']:
+                self.resyncs += 1
+                await ws.send(json.dumps({'type': 'resync', 'stream': message['stream']}))
+                return
+            data = apply_patch(current[1], message['patch'])
+            snapshots[message['stream']] = (message['version'], data)
+            await ws.send(json.dumps({'type': 'delta_ack', 'stream': message['stream'], 'version': message['version']}))
+            message = {'type': message['messageType'], 'data': data}
+        elif 'version' in message and message['type'] in DELTA_STREAMS:
+            stream = DELTA_STREAMS[message['type']]
+            snapshots[stream] = (message['version'], message['data'])
+            await ws.send(json.dumps({'type': 'delta_ack', 'stream': stream, 'version': message['version']}))
+
+        if message['type'] == 'heartbeat':
+            self.heartbeats += 1
+        elif message['type'] == 'result':
+            future = self.pending.pop(message.get('commandId'), None)
+            if future and not future.done():
+                future.set_result(time.perf_counter())
+            await ws.send(json.dumps({'type': 'result_ack', 'commandId': message.get('commandId')}))
+
+    async def run_commands(self, command, rounds, timeout):
+        """Each agent runs `rounds` commands back to back, all agents at once"""
+        latencies = []
+        failures = 0
+
+        async def drive(agent_id, ws):
+            nonlocal failures
+            for index in range(rounds):
+                command_id = f"bench-{agent_id}-{index}"
+                future = asyncio.get_running_loop().create_future()
+                self.pending[command_id] = future
+                sent = time.perf_counter()
+                try:
+                    await ws.send(json.dumps({
+                        'type': 'execute',
+                        'command': command,
+                        'commandId': command_id,
+                        'requireConfirmation': False
+                    }))
+                    latencies.append(await asyncio.wait_for(future, timeout) - sent)
+                except (asyncio.TimeoutError, websockets.exceptions.ConnectionClosed):
+                    self.pending.pop(command_id, None)
+                    failures += 1
+
+        await asyncio.gather(*(drive(agent_id, ws) for agent_id, ws in list(self.connections.items())))
+        return latencies, failures
+
+
+def install_stub_collectors(agent_main, seed):
+    """Replace telemetry and inventory collection with fixed, seeded data"""
+    rng = random.Random(seed)
+    inventory = {
+        'hostname': 'bench-host',
+        'platform': 'Windows',
+        'platform_release': '10',
+        'platform_version': '10.0.19045',
+        'architecture': 'AMD64',
+        'processor': 'Intel64 Family 6',
+        'cpu_count': 8,
+        'cpu_percent': 10.0,
+        'memory': {'total': 17179869184, 'available': 8589934592, 'percent': 50.0},
+        'disk': [{'device': 'C:\\', 'mountpoint': 'C:\\', 'total': 512110190592,
+                  'used': 256055095296, 'free': 256055095296, 'percent': 50.0}],
+        'network': {'hostname': 'bench-host', 'ip': '10.0.0.2'},
+        'top_processes': {
+            'by_cpu': [{'pid': 1000 + i, 'name': f'proc{i}.exe', 'cpu': 10.0 - i, 'memory': 1.0, 'threads': 4}
+                       for i in range(10)],
+            'by_memory': [{'pid': 2000 + i, 'name': f'proc{i}.exe', 'cpu': 1.0, 'memory': 10.0 - i, 'threads': 4}
+                          for i in range(10)]
+        },
+        'services': [{'name': f'svc{i}', 'display_name': f'Service {i}', 'state': 'RUNNING'} for i in range(50)]
+    }
+
+    def get_system_info(sections=None, max_age=None):
+        return json.loads(json.dumps(inventory))
+
+    def get_quick_stats():
+        # Small wobble, like an idle machine
+        return {
+            'cpu_percent': round(rng.uniform(5, 15), 1),
+            'memory_percent': round(rng.uniform(49, 51), 1),
+            'disk_percent': 50.0
+        }
+
+    agent_main.get_system_info = get_system_info
+    agent_main.get_quick_stats = get_quick_stats
+
+
+async def stub_execute(command, command_id=None, timeout=None, on_output=None):
+    return {'success': True, 'output': 'ok\n', 'returncode': 0}
+
+
+async def run_agents(worker, count, args, stop_event):
+    import main as agent_main
+    from metrics import metrics, monitor_event_loop
+
+    install_stub_collectors(agent_main, args.seed + worker)
+    process = psutil.Process()
+    rss_before = process.memory_info().rss
+    lag_monitor = asyncio.create_task(monitor_event_loop(0.1))
+
+    agents = []
+    connect_times = []
+    started = time.perf_counter()
+    for index in range(count):
+        agent = agent_main.RemoteAgent(
+            agent_id=f"bench-{worker}-{index}", token=TOKEN,
+            nickname=f"bench-{worker}-{index}", tags=['bench']
+        )
+        if args.stub_commands:
+            agent.executor.execute = stub_execute
+        agents.append(agent)
+
+    def track(agent, start):
+        on_connected = agent.on_connected
+
+        def wrapper(url, ws):
+            if not hasattr(agent, 'bench_connected'):
+                agent.bench_connected = time.perf_counter() - start
+                connect_times.append(agent.bench_connected)
+            return on_connected(url, ws)
+        agent.on_connected = wrapper
+
+    tasks = []
+    for agent in agents:
+        track(agent, time.perf_counter())
+        tasks.append(asyncio.create_task(agent.run()))
+        if args.ramp:
+            await asyncio.sleep(args.ramp / count)
+
+    while len(connect_times) < count and not stop_event.is_set():
+        await asyncio.sleep(0.05)
+    all_connected = time.perf_counter() - started
+    rss_connected = process.memory_info().rss
+    cpu_start = process.cpu_times()
+    steady_start = time.perf_counter()
+
+    while not stop_event.is_set():
+        await asyncio.sleep(0.1)
+
+    cpu_end = process.cpu_times()
+    steady = time.perf_counter() - steady_start
+    cpu_seconds = (cpu_end.user + cpu_end.system) - (cpu_start.user + cpu_start.system)
+
+    for agent in agents:
+        agent.running = False
+    for task in tasks:
+        task.cancel()
+    lag_monitor.cancel()
+    await asyncio.gather(*tasks, lag_monitor, return_exceptions=True)
+
+    lag = metrics.snapshot()['histograms'].get('event_loop_lag_seconds', {})
+    return {
+        'worker': worker,
+        'agents': count,
+        'connect_times': connect_times,
+        'all_connected': all_connected,
+        'rss_per_agent': (rss_connected - rss_before) / max(count, 1),
+        'rss': rss_connected,
+        'cpu_percent_per_agent': cpu_seconds / steady * 100 / max(count, 1) if steady else 0.0,
+        'cpu_percent': cpu_seconds / steady * 100 if steady else 0.0,
+        'loop_lag_p99': lag.get('p99')
+    }
+
+
+def worker_main(worker, count, args, stop_event, results):
+    """Entry point of a worker process"""
+    if not args.verbose:
+        sys.stdout = open(os.devnull, 'w')
+    results.put(asyncio.run(run_agents(worker, count, args, stop_event)))
+
+
+def raise_file_limit():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def bench(args):
+    server = StandInServer(args.encoding)
+    server.expected = args.agents
+
+    # Workers inherit this environment, set it before they start
+    os.environ.update({
+        'SERVER_URL': f'ws://127.0.0.1:{args.port}',
+        'AGENT_TOKEN': TOKEN,
+        'DISCOVERY_CACHE_PATH': '',
+        'OUTBOX_DIR': '',
+        'METRICS_PORT': '',
+        'SHELL_POOL': 'true' if args.shell_pool else 'false',
+        'HEARTBEAT_INTERVAL': str(args.heartbeat_interval),
+        # Fixed cadence, the stub stats would otherwise let agents back off
+        'HEARTBEAT_MAX_INTERVAL': str(args.heartbeat_interval),
+        'HEARTBEAT_MIN_INTERVAL': str(min(args.heartbeat_interval, 2))
+    })
+
+    context = multiprocessing.get_context('spawn')
+    stop_event = context.Event()
+    results = context.Queue()
+    per_worker = [args.agents // args.processes + (1 if i < args.agents % args.processes else 0)
+                  for i in range(args.processes)]
+
+    async with websockets.serve(server.handler, '127.0.0.1', args.port, max_size=None):
+        started = time.perf_counter()
+        workers = [
+            context.Process(target=worker_main, args=(i, count, args, stop_event, results), daemon=True)
+            for i, count in enumerate(per_worker) if count
+        ]
+        for process in workers:
+            process.start()
+
+        try:
+            await asyncio.wait_for(server.connected.wait(), timeout=args.connect_timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠ Only {len(server.connections)} of {args.agents} agents connected")
+        connected_after = time.perf_counter() - started
+
+        heartbeats_before = server.heartbeats
+        window_start = time.perf_counter()
+        latencies, failures = await server.run_commands(args.command, args.rounds, args.command_timeout)
+        remaining = args.duration - (time.perf_counter() - window_start)
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+        window = time.perf_counter() - window_start
+        heartbeats = server.heartbeats - heartbeats_before
+
+        stop_event.set()
+        reports = [await asyncio.to_thread(results.get, True, 60) for _ in workers]
+        for process in workers:
+            await asyncio.to_thread(process.join, 10)
+
+    connect_times = [t for report in reports for t in report['connect_times']]
+    print(f"Agents:            {len(connect_times)}/{args.agents} connected across {len(workers)} process(es)")
+    print(f"Fleet connected:   {connected_after:.2f}s")
+    print(f"Time-to-connected: {summarize(connect_times)}")
+    print(f"Command RTT:       {summarize(latencies)}  ({len(latencies)} ok, {failures} failed, "
+          f"{'stub' if args.stub_commands else repr(args.command)})")
+    print(f"Heartbeats:        {heartbeats / window:.1f}/s over {window:.1f}s "
+          f"(expected ~{len(connect_times) / args.heartbeat_interval:.1f}/s), {server.resyncs} resyncs")
+    print(f"Server received:   {server.messages} messages, {server.bytes_received / 1024:.0f} KiB")
+    for report in sorted(reports, key=lambda r: r['worker']):
+        print(
+            f"Worker {report['worker']}: {report['agents']} agents, "
+            f"RSS {report['rss'] / 2**20:.0f} MiB ({report['rss_per_agent'] / 1024:.0f} KiB/agent), "
+            f"CPU {report['cpu_percent']:.1f}% ({report['cpu_percent_per_agent']:.3f}%/agent), "
+            f"loop lag p99 {(report['loop_lag_p99'] or 0) * 1000:.1f}ms"
+        )
+    if latencies:
+        print(f"Mean command RTT:  {statistics.mean(latencies) * 1000:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--agents', type=int, default=200)
+    parser.add_argument('--processes', type=int, default=1, help='Worker processes the agents are spread over')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--rounds', type=int, default=5, help='Commands each agent runs back to back')
+    parser.add_argument('--command', default='echo ok')
+    parser.add_argument('--stub-commands', action='store_true', help='Measure the protocol only, no process spawn')
+    parser.add_argument('--shell-pool', action='store_true', help='Run commands with SHELL_POOL=true')
+    parser.add_argument('--heartbeat-interval', type=float, default=2.0)
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds of steady state to measure')
+    parser.add_argument('--ramp', type=float, default=0.0, help='Seconds to spread agent startup over')
+    parser.add_argument('--encoding', choices=['json', 'msgpack'], default='json')
+    parser.add_argument('--connect-timeout', type=float, default=60.0)
+    parser.add_argument('--command-timeout', type=float, default=30.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help="Show the agents' own output")
+    args = parser.parse_args()
+    args.processes = max(1, min(args.processes, args.agents))
+
+    raise_file_limit()
+    asyncio.run(bench(args))
+
+
+if __name__ == '__main__':
+    main()
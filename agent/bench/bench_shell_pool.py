@@ -0,0 +1,81 @@
+"""
+Shell pool benchmark
+Compares spawning a shell per command with running commands in pooled
+long-lived bash sessions (Linux/macOS)
+
+Usage: python bench/bench_shell_pool.py [--commands N] [--concurrency N]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from executor import CommandExecutor  # noqa: E402
+from shell_pool import BashProfile, ShellPool  # noqa: E402
+
+# Small commands like the ones scheduled maintenance templates send
+WORKLOAD = ['echo ok', 'pwd', 'uname -a', 'date +%s', 'ls /', 'true']
+
+
+async def spawn_bash(command):
+    proc = await asyncio.create_subprocess_exec(
+        'bash', '-c', command,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    await proc.communicate()
+    return proc.returncode
+
+
+async def measure(name, run, commands, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(command):
+        async with semaphore:
+            start = time.perf_counter()
+            await run(command)
+            latencies.append(time.perf_counter() - start)
+
+    # Warm up (starts pooled sessions) outside the timed run
+    await asyncio.gather(*(one(WORKLOAD[0]) for _ in range(concurrency)))
+    latencies.clear()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(WORKLOAD[i % len(WORKLOAD)]) for i in range(commands)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{name:<28} {commands / elapsed:>10.0f} {statistics.median(latencies) * 1000:>10.2f} {p95 * 1000:>10.2f}")
+    return commands / elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--commands', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=4)
+    args = parser.parse_args()
+
+    spawn_executor = CommandExecutor(max_concurrent=args.concurrency)
+    pool = ShellPool(size=args.concurrency, profile=BashProfile())
+    pooled_executor = CommandExecutor(max_concurrent=args.concurrency, pool=pool)
+
+    print(f"{args.commands} commands, concurrency {args.concurrency}\n")
+    print(f"{'mode':<28} {'cmds/s':>10} {'p50 ms':>10} {'p95 ms':>10}")
+    print('-' * 62)
+    spawn_rate = await measure('spawn: bash -c', spawn_bash, args.commands, args.concurrency)
+    await measure('spawn: executor (/bin/sh)', spawn_executor.execute, args.commands, args.concurrency)
+    pooled_rate = await measure('pooled: bash sessions', pooled_executor.execute, args.commands, args.concurrency)
+    await pool.close()
+
+    print(f"\nPooled throughput vs bash -c: {pooled_rate / spawn_rate:.1f}x")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
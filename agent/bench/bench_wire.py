@@ -0,0 +1,101 @@
+"""
+Wire format benchmark
+Compares bytes on the wire and encode/decode CPU time for typical agent
+messages across JSON, MessagePack and zlib compression
+
+Usage: python bench/bench_wire.py [--iterations N]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from delta import diff  # noqa: E402
+from system_info import get_system_info  # noqa: E402
+from wire import WireCodec, msgpack  # noqa: E402
+
+
+def build_payloads():
+    """Typical messages: heartbeat, inventory, inventory delta, command results"""
+    stats = {'cpu_percent': 12.5, 'memory_percent': 63.1, 'disk_percent': 41.0}
+    inventory = get_system_info()
+    # Windows inventories also carry up to 100 services
+    inventory.setdefault('services', [
+        {'name': f'Service{i}', 'display_name': f'Example Service Number {i}', 'state': 'RUNNING' if i % 3 else 'STOPPED'}
+        for i in range(100)
+    ])
+    changed = json.loads(json.dumps(inventory))
+    changed['cpu_percent'] = 37.5
+    changed['memory']['percent'] = 64.2
+
+    listing = ''.join(
+        f"01/{i % 28 + 1:02d}/2026  10:{i % 60:02d} AM    {i * 137 % 100000:>12,} file_{i:05d}.log\n"
+        for i in range(2000)
+    )
+
+    return {
+        'heartbeat': {'type': 'heartbeat', 'version': 42, 'data': stats},
+        'agent_info': {'type': 'agent_info', 'version': 1, 'data': inventory},
+        'system_info delta': {
+            'type': 'delta', 'stream': 'system_info', 'messageType': 'system_info',
+            'base': 1, 'version': 2, 'patch': diff(inventory, changed)
+        },
+        'result (dir listing)': {
+            'type': 'result', 'command': 'dir /s C:\\logs', 'commandId': 'cmd-1',
+            'success': True, 'output': listing
+        },
+        'result_chunk (16 KB)': {
+            'type': 'result_chunk', 'commandId': 'cmd-2', 'stream': 'stdout',
+            'seq': 7, 'data': listing[:16384]
+        }
+    }
+
+
+def time_call(fn, arg, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(arg)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--threshold', type=int, default=1024, help='zlib threshold in bytes')
+    args = parser.parse_args()
+
+    formats = [('json', None), ('json', 'zlib')]
+    if msgpack is not None:
+        formats += [('msgpack', None), ('msgpack', 'zlib')]
+    else:
+        print("⚠ msgpack not installed, skipping MessagePack formats\n")
+
+    print(f"{'payload':<22} {'format':<16} {'bytes':>9} {'ratio':>7} {'encode us':>10} {'decode us':>10}")
+    print('-' * 78)
+    for name, message in build_payloads().items():
+        baseline = len(json.dumps(message).encode('utf-8'))
+        for encoding, compression in formats:
+            codec = WireCodec(encoding, compression, threshold=args.threshold)
+            frame = codec.encode(message)
+            size = len(frame.encode('utf-8') if isinstance(frame, str) else frame)
+            encode_us = time_call(codec.encode, message, args.iterations)
+            decode_us = time_call(codec.decode, frame, args.iterations)
+            label = encoding + (f'+{compression}' if compression else '')
+            print(f"{name:<22} {label:<16} {size:>9} {size / baseline:>7.2f} {encode_us:>10.1f} {decode_us:>10.1f}")
+
+        # permessage-deflate is raw deflate of the JSON text, done by the WebSocket layer.
+        # A fresh compressor per payload, so the size is one message on its own and
+        # not helped by the window the previous payloads left behind
+        deflate = zlib.compressobj(6, zlib.DEFLATED, -15)
+        text = json.dumps(message).encode('utf-8')
+        size = len(deflate.compress(text) + deflate.flush(zlib.Z_SYNC_FLUSH))
+        print(f"{name:<22} {'json+pm-deflate':<16} {size:>9} {size / baseline:>7.2f} {'-':>10} {'-':>10}")
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""
+Beacon discovery
+Finds servers in one UDP round trip instead of a port scan: the agent
+broadcasts and multicasts a discover query, every server running a beacon
+responder answers with its WebSocket URL and a load hint, and the replies
+that arrive within a short window are ranked, least loaded first.
+
+Run this module to answer queries for a server that has no responder of
+its own: python beacon.py --url ws://192.168.1.10:3000
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import socket
+import struct
+import uuid
+
+import psutil
+
+DEFAULT_BEACON_PORT = 3001
+DEFAULT_GROUP = '239.255.77.77'
+PROTOCOL_VERSION = 1
+
+
+def beacon_targets(networks, group=None):
+    """Addresses to send the query to: this host, limited broadcast, each subnet's broadcast and the group"""
+    if group is None:
+        group = os.getenv('DISCOVERY_BEACON_GROUP', DEFAULT_GROUP)
+    targets = ['127.0.0.1', '255.255.255.255']
+    for _, network in networks:
+        address = str(network.broadcast_address)
+        if address not in targets:
+            targets.append(address)
+    if group:
+        targets.append(group)
+    return targets
+
+
+def load_hint(value):
+    """A reply's load or agent count if it is a plausible one, else None
+
+    Replies are unauthenticated, a negative, NaN or non-numeric hint must not
+    rank a host ahead of honest ones.
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    if not math.isfinite(value) or value < 0:
+        return None
+    return value
+
+
+def rank_replies(replies):
+    """Least loaded first, then fewest agents, then quickest to answer; unknown hints last"""
+    def key(reply):
+        load = load_hint(reply.get('load'))
+        agents = load_hint(reply.get('agents'))
+        return (
+            float('inf') if load is None else load,
+            float('inf') if agents is None else agents,
+            reply['rtt']
+        )
+    return sorted(replies, key=key)
+
+
+class _ReplyCollector(asyncio.DatagramProtocol):
+    """Keeps beacon replies to one query, one per server URL"""
+
+    def __init__(self, nonce, sent_at):
+        self.nonce = nonce
+        self.sent_at = sent_at
+        self.replies = {}  # url -> reply
+
+    def datagram_received(self, data, addr):
+        try:
+            reply = json.loads(data)
+        except ValueError:
+            return
+        if not isinstance(reply, dict) or reply.get('type') != 'beacon' or reply.get('nonce') != self.nonce:
+            return
+        # Servers behind NAT or a proxy announce a url, the rest are reached where they answered from
+        url = reply.get('url') or f"{reply.get('scheme', 'ws')}://{addr[0]}:{int(reply.get('port', 3000))}"
+        if url not in self.replies:
+            reply['url'] = url
+            reply['load'] = load_hint(reply.get('load'))
+            reply['agents'] = load_hint(reply.get('agents'))
+            reply['rtt'] = round(asyncio.get_running_loop().time() - self.sent_at, 4)
+            self.replies[url] = reply
+
+    def error_received(self, exc):
+        pass  # Unreachable targets (e.g. no multicast route) are normal here
+
+
+async def query_beacons(targets, port=None, window=None):
+    """Send one discover query to every target and rank the replies that arrive within window seconds"""
+    if port is None:
+        port = int(os.getenv('DISCOVERY_BEACON_PORT', DEFAULT_BEACON_PORT))
+    if window is None:
+        window = int(os.getenv('DISCOVERY_BEACON_WINDOW_MS', 300)) / 1000
+
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)  # Stay on the local network
+    sock.bind(('', 0))
+
+    nonce = uuid.uuid4().hex
+    transport, collector = await loop.create_datagram_endpoint(
+        lambda: _ReplyCollector(nonce, loop.time()), sock=sock
+    )
+    try:
+        query = json.dumps({'type': 'discover', 'version': PROTOCOL_VERSION, 'nonce': nonce}).encode()
+        for target in targets:
+            try:
+                transport.sendto(query, (target, port))
+            except OSError:
+                pass
+        await asyncio.sleep(window)
+    finally:
+        transport.close()
+    return rank_replies(collector.replies.values())
+
+
+class BeaconResponder(asyncio.DatagramProtocol):
+    """Answers discover queries with what describe() returns"""
+
+    def __init__(self, describe):
+        self.describe = describe  # () -> dict with scheme/port or url, plus load hints
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            query = json.loads(data)
+        except ValueError:
+            return
+        if not isinstance(query, dict) or query.get('type') != 'discover':
+            return
+        reply = {'type': 'beacon', 'version': PROTOCOL_VERSION, 'nonce': query.get('nonce')}
+        reply.update(self.describe())
+        self.transport.sendto(json.dumps(reply).encode(), addr)
+
+
+async def start_responder(describe, port=None, group=None, host='0.0.0.0'):
+    """Listen for discover queries on udp/port, joining the multicast group when possible"""
+    if port is None:
+        port = int(os.getenv('DISCOVERY_BEACON_PORT', DEFAULT_BEACON_PORT))
+    if group is None:
+        group = os.getenv('DISCOVERY_BEACON_GROUP', DEFAULT_GROUP)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    if group:
+        try:
+            membership = struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton('0.0.0.0'))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        except OSError as e:
+            print(f"⚠ Could not join multicast group {group}, answering broadcasts only: {e}")
+
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(lambda: BeaconResponder(describe), sock=sock)
+    return transport
+
+
+def host_load():
+    """1-minute load average per CPU, comparable across machines
+
+    None on Windows, where psutil only emulates a load average that starts
+    at zero and would make a busy host look idle.
+    """
+    if platform.system() == 'Windows':
+        return None
+    try:
+        return round(psutil.getloadavg()[0] / (psutil.cpu_count() or 1), 3)
+    except (AttributeError, OSError):
+        return None
+
+
+async def _serve(args):
+    def describe():
+        return {'url': args.url, 'name': args.name, 'agents': args.agents, 'load': host_load()}
+
+    await start_responder(describe, args.port, args.group)
+    print(f"✓ Beacon answering on udp/{args.port} with {args.url}")
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in beacon responder for a server without one')
+    parser.add_argument('--url', required=True, help='WebSocket URL to announce, e.g. ws://192.168.1.10:3000')
+    parser.add_argument('--port', type=int, default=int(os.getenv('DISCOVERY_BEACON_PORT', DEFAULT_BEACON_PORT)))
+    parser.add_argument('--group', default=os.getenv('DISCOVERY_BEACON_GROUP', DEFAULT_GROUP))
+    parser.add_argument('--name', default=socket.gethostname())
+    parser.add_argument('--agents', type=int, default=None, help='Connected agents to report, unknown by default')
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
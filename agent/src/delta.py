@@ -0,0 +1,103 @@
+"""
+Delta encoding for snapshot messages
+Sends only what changed since the last snapshot the server acknowledged
+"""
+
+_MISSING = object()
+
+
+def diff(old, new, path=None, patch=None):
+    """Build a patch that turns old into new
+
+    Dicts are compared key by key and lists of the same length item by item;
+    anything else that differs is replaced whole. Paths are lists of dict
+    keys and list indexes.
+    """
+    if path is None:
+        path = []
+    if patch is None:
+        patch = {'set': [], 'unset': []}
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key, value in new.items():
+            old_value = old.get(key, _MISSING)
+            if old_value is _MISSING:
+                patch['set'].append([path + [key], value])
+            else:
+                diff(old_value, value, path + [key], patch)
+        for key in old:
+            if key not in new:
+                patch['unset'].append(path + [key])
+    elif isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        for index, (old_value, value) in enumerate(zip(old, new)):
+            diff(old_value, value, path + [index], patch)
+    elif old != new or type(old) is not type(new):
+        patch['set'].append([path, new])
+
+    return patch
+
+
+def apply_patch(snapshot, patch):
+    """Apply a patch from diff() to a copy of snapshot"""
+    result = _copy(snapshot)
+    for path, value in patch.get('set', []):
+        if not path:
+            result = _copy(value)
+            continue
+        target = result
+        for key in path[:-1]:
+            target = target[key]
+        target[path[-1]] = _copy(value)
+    for path in patch.get('unset', []):
+        target = result
+        for key in path[:-1]:
+            target = target[key]
+        del target[path[-1]]
+    return result
+
+
+def _copy(value):
+    if isinstance(value, dict):
+        return {key: _copy(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    return value
+
+
+class DeltaEncoder:
+    """Tracks versions of one snapshot stream (heartbeat, system_info)
+
+    A delta is only sent when every earlier version has been acknowledged,
+    so the server always holds the base the patch applies to. Servers that
+    never acknowledge keep getting full snapshots.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forget the acknowledged base, the next snapshot is sent in full"""
+        self.version = 0
+        self.acked_version = None
+        self.acked_snapshot = None
+        self.pending = None  # (version, snapshot) waiting for an ack
+
+    def encode(self, snapshot):
+        """Get the fields for the next message, full or delta"""
+        self.version += 1
+        base_is_current = self.acked_snapshot is not None and self.pending is None
+
+        self.pending = (self.version, snapshot)
+        if base_is_current:
+            return {
+                'base': self.acked_version,
+                'version': self.version,
+                'patch': diff(self.acked_snapshot, snapshot)
+            }
+        return {'version': self.version, 'data': snapshot}
+
+    def ack(self, version):
+        """The server has applied version, it becomes the new base"""
+        if self.pending and self.pending[0] == version:
+            self.acked_version, self.acked_snapshot = self.pending
+            self.pending = None
@@ -0,0 +1,291 @@
+"""
+Server discovery module
+Finds candidate server URLs on the local network with a UDP beacon query,
+falling back to the ARP table, the real interface netmasks and parallel
+asyncio port probes
+"""
+import asyncio
+import ipaddress
+import json
+import os
+import re
+import socket
+import subprocess
+import time
+
+import psutil
+
+from beacon import beacon_targets, query_beacons
+from metrics import metrics
+
+DEFAULT_PORT = 3000
+
+
+class DiscoveryCache:
+    """On-disk cache of server URLs that worked recently
+
+    Each URL keeps the time of its last successful connection and a score
+    that goes up on success and down on failure, so the agent can try the
+    servers it knows before running a full discovery. A URL is only dropped
+    when its TTL runs out or after MAX_FAILURES failures in a row, so one
+    failed attempt during a server restart doesn't forget it.
+    """
+
+    MAX_SCORE = 10
+    MAX_FAILURES = 3
+
+    def __init__(self, path=None, ttl=None):
+        if path is None:
+            path = os.getenv('DISCOVERY_CACHE_PATH', 'discovery_cache.json')
+        if ttl is None:
+            ttl = int(os.getenv('DISCOVERY_CACHE_TTL_HOURS', 168)) * 3600
+
+        self.path = path  # Empty path disables the cache
+        self.ttl = ttl
+        self.entries = self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            return {url: entry for url, entry in entries.items() if isinstance(entry, dict)}
+        except Exception as e:
+            print(f"⚠ Could not read discovery cache: {e}")
+            return {}
+
+    def _save(self):
+        if not self.path:
+            return
+        try:
+            # Write to a temp file first so a crash never leaves a torn cache
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"⚠ Could not write discovery cache: {e}")
+
+    def get_urls(self):
+        """Get cached URLs that haven't expired, best first"""
+        now = time.time()
+        fresh = [
+            (url, entry) for url, entry in self.entries.items()
+            if now - entry.get('last_success', 0) < self.ttl
+        ]
+        fresh.sort(key=lambda item: (item[1].get('score', 0), item[1].get('last_success', 0)), reverse=True)
+        return [url for url, _ in fresh]
+
+    def record_success(self, url):
+        """Remember a URL the agent just connected to"""
+        if not self.path:
+            return
+        entry = self.entries.setdefault(url, {'score': 0})
+        entry['score'] = min(entry.get('score', 0) + 1, self.MAX_SCORE)
+        entry['last_success'] = time.time()
+        entry['failures'] = 0
+        self._save()
+
+    def record_failure(self, url):
+        """Lower the score of a cached URL, dropping it after MAX_FAILURES failures in a row"""
+        entry = self.entries.get(url)
+        if entry is None:
+            return
+        entry['score'] = max(entry.get('score', 0) - 1, 0)
+        entry['failures'] = entry.get('failures', 0) + 1
+        if entry['failures'] >= self.MAX_FAILURES:
+            del self.entries[url]
+        self._save()
+
+
+def get_arp_table():
+    """Get list of active IPs from ARP table"""
+    try:
+        result = subprocess.run(['arp', '-a'], capture_output=True, text=True, timeout=10)
+        ips = []
+
+        # Parse ARP table output
+        for line in result.stdout.split('\n'):
+            # Look for lines with IP addresses (format: 192.168.1.1)
+            match = re.search(r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})', line)
+            if match:
+                ip = match.group(1)
+                # Skip multicast and broadcast addresses
+                if not ip.startswith('224.') and not ip.endswith('.255') and ip not in ips:
+                    ips.append(ip)
+
+        print(f"✓ Found {len(ips)} active hosts via ARP")
+        return ips
+    except Exception as e:
+        print(f"⚠ Could not scan ARP table: {e}")
+        return []
+
+
+def get_default_gateway():
+    """Get the default gateway IP address"""
+    try:
+        result = subprocess.run(['ipconfig'], capture_output=True, text=True, timeout=10)
+        # Look for "Default Gateway" line
+        for line in result.stdout.split('\n'):
+            if 'Default Gateway' in line or 'Passerelle par défaut' in line:
+                # Extract IP address
+                match = re.search(r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})', line)
+                if match:
+                    return match.group(1)
+    except Exception as e:
+        print(f"⚠ Could not detect gateway: {e}")
+    return None
+
+
+def get_local_networks(max_hosts=1024):
+    """Get (local_ip, network) for every IPv4 interface, using its real netmask
+
+    Networks larger than max_hosts are narrowed to the largest block around
+    the local IP that fits, so a /16 doesn't turn into 65k probes.
+    """
+    networks = []
+    try:
+        stats = psutil.net_if_stats()
+        for name, addrs in psutil.net_if_addrs().items():
+            if name in stats and not stats[name].isup:
+                continue
+
+            for addr in addrs:
+                if addr.family != socket.AF_INET or not addr.netmask:
+                    continue
+
+                ip = ipaddress.IPv4Address(addr.address)
+                if ip.is_loopback or ip.is_link_local:
+                    continue
+
+                network = ipaddress.IPv4Network(f"{addr.address}/{addr.netmask}", strict=False)
+                while network.num_addresses - 2 > max_hosts and network.prefixlen < 30:
+                    network = ipaddress.IPv4Network(f"{addr.address}/{network.prefixlen + 1}", strict=False)
+
+                if (addr.address, network) not in networks:
+                    networks.append((addr.address, network))
+    except Exception as e:
+        print(f"⚠ Could not read network interfaces: {e}")
+    return networks
+
+
+async def probe_port(ip, port=DEFAULT_PORT, timeout=0.5):
+    """Check if a TCP port accepts connections"""
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout=timeout)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+        return True
+    except Exception:
+        return False
+
+
+async def scan_hosts(ips, port=DEFAULT_PORT, timeout=0.5, concurrency=256):
+    """Probe many hosts at once, returns the ones with the port open in input order"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def probe(ip):
+        async with semaphore:
+            return await probe_port(ip, port, timeout)
+
+    results = await asyncio.gather(*(probe(ip) for ip in ips))
+    return [ip for ip, is_open in zip(ips, results) if is_open]
+
+
+async def discover_server_urls():
+    """Generate list of server URLs to try, in priority order
+
+    Servers running a beacon responder are found with one UDP round trip.
+    Beacon replies are unauthenticated, so they rank after localhost and
+    the port scan still runs, a rogue reply can't crowd out real servers.
+    """
+    urls = []
+
+    # 1. Configured URL (highest priority)
+    configured_url = os.getenv('SERVER_URL')
+    if configured_url and configured_url != 'auto':
+        urls.append(configured_url)
+        return urls  # If explicitly configured, only try that
+
+    port = int(os.getenv('DISCOVERY_PORT', DEFAULT_PORT))
+    timeout = int(os.getenv('DISCOVERY_PROBE_TIMEOUT_MS', 500)) / 1000
+    concurrency = int(os.getenv('DISCOVERY_CONCURRENCY', 256))
+    max_hosts = int(os.getenv('DISCOVERY_MAX_HOSTS', 1024))
+
+    print("\n🔍 Starting server discovery...")
+    started = time.perf_counter()
+
+    # 2. Localhost (same machine)
+    print("→ Checking localhost...")
+    urls.append(f'ws://localhost:{port}')
+    urls.append(f'ws://127.0.0.1:{port}')
+
+    # 3. Beacons: servers answer a broadcast/multicast query with their URL and load
+    beacon_urls = []
+    if os.getenv('DISCOVERY_BEACON', 'true').lower() == 'true':
+        print("→ Asking servers for beacons...")
+        # Real netmasks here, a broadcast costs the same on any size of subnet
+        replies = await query_beacons(beacon_targets(get_local_networks(max_hosts=2 ** 32)))
+        for reply in replies:
+            load = reply.get('load')
+            agents = reply.get('agents')
+            print(f"  ✓ {reply['url']} answered in {reply['rtt'] * 1000:.0f}ms "
+                  f"(load {'?' if load is None else load}, {'?' if agents is None else agents} agents)")
+            if reply['url'] not in urls:
+                urls.append(reply['url'])
+                beacon_urls.append(reply['url'])
+        if not replies:
+            print("→ No beacon replies")
+
+    # Gateway and ARP lookups shell out, run them side by side off the event loop
+    gateway, arp_ips = await asyncio.gather(
+        asyncio.to_thread(get_default_gateway),
+        asyncio.to_thread(get_arp_table)
+    )
+
+    # 4. Default gateway (router/server on network)
+    if gateway and gateway not in ['0.0.0.0', '']:
+        print(f"→ Detected gateway: {gateway}")
+        urls.append(f'ws://{gateway}:{port}')
+
+    # 5. Probe ARP hosts and every host on the local subnets in one parallel sweep
+    candidates = list(arp_ips)
+    for local_ip, network in get_local_networks(max_hosts):
+        print(f"→ Local IP: {local_ip} (network {network})")
+        for host in network.hosts():
+            ip = str(host)
+            if ip != local_ip and ip not in candidates:
+                candidates.append(ip)
+
+    print(f"→ Checking port {port} on {len(candidates)} hosts ({concurrency} at a time)...")
+    found_hosts = await scan_hosts(candidates, port, timeout, concurrency)
+    for ip in found_hosts:
+        print(f"  ✓ Port {port} open on {ip}")
+        url = f'ws://{ip}:{port}'
+        if url not in urls:
+            urls.append(url)
+
+    # 6. Common server names (DNS)
+    print("→ Trying common DNS names...")
+    urls.append(f'ws://server.local:{port}')
+    urls.append(f'ws://remote-agent-server:{port}')
+    urls.append(f'ws://remote-agent:{port}')
+
+    # 7. Fallback to common gateway IPs (ONLY if nothing else worked)
+    if not found_hosts and not beacon_urls:
+        print("→ No servers found, trying fallback IPs...")
+        fallback_ips = ['192.168.1.1', '192.168.0.1', '10.0.0.1', '172.16.0.1']
+        for ip in fallback_ips:
+            url = f'ws://{ip}:{port}'
+            if url not in urls:
+                urls.append(url)
+    else:
+        print(f"→ Skipping fallback IPs (found {len(found_hosts)} servers by port scan)")
+
+    metrics.observe('discovery_seconds', time.perf_counter() - started)
+    print(f"\n✓ Discovery complete: {len(urls)} potential servers found\n")
+    return urls
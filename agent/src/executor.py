@@ -0,0 +1,303 @@
+"""
+Command execution engine
+Runs shell commands as asyncio subprocesses so the agent's event loop
+stays responsive while commands are running
+"""
+import asyncio
+import codecs
+import locale
+import os
+import time
+
+import psutil
+
+from metrics import metrics
+
+
+def kill_process_tree(pid):
+    """Kill a process and all of its descendants, leaving pid for the caller to wait on"""
+    try:
+        parent = psutil.Process(pid)
+    except psutil.NoSuchProcess:
+        return
+
+    try:
+        children = parent.children(recursive=True)
+    except psutil.Error:
+        children = []
+
+    # Kill children first so the shell can't respawn anything
+    for proc in children + [parent]:
+        try:
+            proc.kill()
+        except psutil.Error:
+            pass
+
+    # Only the descendants: pid is asyncio's child, the caller's proc.wait()
+    # reaps it and the child watcher would log it as unknown if we got there first
+    psutil.wait_procs(children, timeout=3)
+
+
+def decode_output(data):
+    """Decode raw subprocess output using the console encoding"""
+    return data.decode(locale.getpreferredencoding(False), errors='replace')
+
+
+async def pump_stream(reader, stream_name, on_output, chunk_size, flush_interval):
+    """Forward a pipe to on_output in chunks of at most chunk_size characters"""
+    # Incremental decoder so multi-byte characters split across reads survive
+    decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))(errors='replace')
+    buffer = ''
+    last_flush = time.monotonic()
+
+    while True:
+        remaining = flush_interval - (time.monotonic() - last_flush)
+        try:
+            # StreamReader.read is safe to cancel, nothing is lost on timeout
+            data = await asyncio.wait_for(reader.read(chunk_size), timeout=max(remaining, 0.01))
+        except asyncio.TimeoutError:
+            data = None
+
+        if data == b'':
+            break
+        if data:
+            buffer += decoder.decode(data)
+
+        # Full chunks go out right away
+        while len(buffer) >= chunk_size:
+            await on_output(stream_name, buffer[:chunk_size])
+            buffer = buffer[chunk_size:]
+            last_flush = time.monotonic()
+
+        # Partial chunks go out once the flush interval has passed
+        if time.monotonic() - last_flush >= flush_interval:
+            if buffer:
+                await on_output(stream_name, buffer)
+                buffer = ''
+            last_flush = time.monotonic()
+
+    buffer += decoder.decode(b'', final=True)
+    while buffer:
+        await on_output(stream_name, buffer[:chunk_size])
+        buffer = buffer[chunk_size:]
+
+
+class CommandExecutor:
+    """Runs commands concurrently with a limit, timeouts and cancellation"""
+
+    def __init__(self, max_concurrent=None, timeout=None, chunk_size=None, flush_interval=None, pool=None):
+        if max_concurrent is None:
+            max_concurrent = int(os.getenv('MAX_CONCURRENT_COMMANDS', 4))
+        if timeout is None:
+            timeout = int(os.getenv('COMMAND_TIMEOUT_MS', 30000)) / 1000
+        if chunk_size is None:
+            chunk_size = int(os.getenv('STREAM_CHUNK_SIZE', 16384))
+        if flush_interval is None:
+            flush_interval = int(os.getenv('STREAM_FLUSH_MS', 500)) / 1000
+
+        self.max_concurrent = max(1, max_concurrent)
+        self.timeout = timeout
+        self.chunk_size = max(1, chunk_size)
+        self.flush_interval = flush_interval
+        self.pool = pool  # Optional ShellPool for buffered commands
+        self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        self._tasks = {}  # commandId -> task running the command
+        self._batches = {}  # batchId -> commandIds of its items
+        self._cancel_requested = set()
+
+    @property
+    def active_count(self):
+        """Number of commands currently queued or running"""
+        return len(self._tasks)
+
+    def cancel(self, command_id):
+        """Cancel a queued or running command or batch, returns False if unknown"""
+        if command_id in self._batches:
+            # Items that haven't started see the flag and are skipped
+            self._cancel_requested.add(command_id)
+            for item_id in self._batches[command_id]:
+                self.cancel(item_id)
+            return True
+
+        task = self._tasks.get(command_id)
+        if task is None or task.done():
+            return False
+
+        self._cancel_requested.add(command_id)
+        task.cancel()
+        return True
+
+    async def execute(self, command, command_id=None, timeout=None, on_output=None):
+        """Execute a shell command and return output
+
+        When on_output is given, stdout and stderr are streamed to it as
+        (stream, text) chunks instead of being buffered, and the returned
+        output is empty.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        if command_id:
+            self._tasks[command_id] = asyncio.current_task()
+
+        proc = None
+        queued_at = time.perf_counter()
+        try:
+            async with self._semaphore:
+                started_at = time.perf_counter()
+                metrics.observe('command_queue_seconds', started_at - queued_at)
+                if self.pool is not None and on_output is None:
+                    return await self._execute_pooled(command, timeout)
+
+                proc = await asyncio.create_subprocess_shell(
+                    command,
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE
+                )
+                spawned_at = time.perf_counter()
+                metrics.observe('command_spawn_seconds', spawned_at - started_at)
+
+                try:
+                    if on_output is None:
+                        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+                    else:
+                        await asyncio.wait_for(self._stream(proc, on_output), timeout=timeout)
+                    metrics.observe('command_run_seconds', time.perf_counter() - spawned_at)
+                except asyncio.TimeoutError:
+                    await asyncio.to_thread(kill_process_tree, proc.pid)
+                    await proc.wait()
+                    return {
+                        'success': False,
+                        'output': 'Command timed out',
+                        'returncode': -1
+                    }
+
+            if on_output is None:
+                stdout = decode_output(stdout)
+                stderr = decode_output(stderr)
+                output = stdout if stdout else stderr
+            else:
+                output = ''
+            return {
+                'success': proc.returncode == 0,
+                'output': output,
+                'returncode': proc.returncode
+            }
+        except asyncio.CancelledError:
+            if proc is not None and proc.returncode is None:
+                await asyncio.to_thread(kill_process_tree, proc.pid)
+                await proc.wait()
+
+            # Only swallow cancellations that were asked for by commandId,
+            # anything else (agent shutdown) must keep propagating
+            if command_id in self._cancel_requested:
+                # Swallowed, so take it back or later timeouts in this task misbehave
+                asyncio.current_task().uncancel()
+                return {
+                    'success': False,
+                    'output': 'Command cancelled',
+                    'returncode': -1
+                }
+            raise
+        except Exception as e:
+            # Don't leave the command running behind a failed result
+            if proc is not None and proc.returncode is None:
+                await asyncio.to_thread(kill_process_tree, proc.pid)
+                await proc.wait()
+            return {
+                'success': False,
+                'output': str(e),
+                'returncode': -1
+            }
+        finally:
+            if command_id:
+                self._tasks.pop(command_id, None)
+                self._cancel_requested.discard(command_id)
+
+    async def execute_batch(self, commands, batch_id, mode='sequential', stop_on_error=True,
+                            concurrency=None, timeout=None):
+        """Run several commands and return one result per command with its timing
+
+        sequential runs them in order, stopping at the first failure when
+        stop_on_error is set; parallel runs up to concurrency at a time.
+        """
+        item_ids = [f"{batch_id}:{index}" for index in range(len(commands))]
+        self._batches[batch_id] = item_ids
+        failed = False
+
+        async def run_item(index):
+            nonlocal failed
+            command = commands[index]
+            if batch_id in self._cancel_requested:
+                return self._skipped(command, 'Batch cancelled')
+            if failed and stop_on_error and mode == 'sequential':
+                return self._skipped(command, 'Skipped after earlier failure')
+
+            started = time.monotonic()
+            result = await self.execute(command, item_ids[index], timeout)
+            result['command'] = command
+            result['durationMs'] = round((time.monotonic() - started) * 1000)
+            if not result['success']:
+                failed = True
+            return result
+
+        try:
+            if mode == 'parallel':
+                semaphore = asyncio.Semaphore(max(1, concurrency or self.max_concurrent))
+
+                async def run_limited(index):
+                    async with semaphore:
+                        return await run_item(index)
+
+                return list(await asyncio.gather(*(run_limited(i) for i in range(len(commands)))))
+
+            return [await run_item(index) for index in range(len(commands))]
+        finally:
+            self._batches.pop(batch_id, None)
+            self._cancel_requested.discard(batch_id)
+
+    def _skipped(self, command, reason):
+        return {
+            'command': command,
+            'success': False,
+            'output': reason,
+            'returncode': None,
+            'durationMs': 0,
+            'skipped': True
+        }
+
+    async def _execute_pooled(self, command, timeout):
+        try:
+            # No spawn to measure, the session already exists
+            with metrics.timer('command_run_seconds'):
+                returncode, stdout, stderr = await self.pool.run(command, timeout)
+        except asyncio.TimeoutError:
+            # The pool has already killed the session running the command
+            return {
+                'success': False,
+                'output': 'Command timed out',
+                'returncode': -1
+            }
+
+        output = stdout if stdout else stderr
+        return {
+            'success': returncode == 0,
+            'output': output,
+            'returncode': returncode
+        }
+
+    async def _stream(self, proc, on_output):
+        pumps = [
+            asyncio.create_task(pump_stream(proc.stdout, 'stdout', on_output, self.chunk_size, self.flush_interval)),
+            asyncio.create_task(pump_stream(proc.stderr, 'stderr', on_output, self.chunk_size, self.flush_interval))
+        ]
+        try:
+            await asyncio.gather(*pumps)
+        except BaseException:
+            # One pump failing (e.g. on_output hit a closed connection) stops the other too
+            for pump in pumps:
+                pump.cancel()
+            await asyncio.gather(*pumps, return_exceptions=True)
+            raise
+        await proc.wait()
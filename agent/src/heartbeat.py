@@ -0,0 +1,130 @@
+"""
+Adaptive heartbeat scheduling
+Spreads heartbeats with jitter, backs off while nothing changes and sends
+early when a metric crosses an alert threshold
+"""
+import asyncio
+import os
+import random
+import time
+
+# Metric -> alert threshold (percent); crossing it either way sends a heartbeat now
+DEFAULT_THRESHOLDS = {
+    'cpu_percent': 90,
+    'memory_percent': 90,
+    'disk_percent': 95
+}
+
+
+class HeartbeatScheduler:
+    """Decides when the next heartbeat is due"""
+
+    def __init__(self, interval=None, max_interval=None, jitter=None, change_threshold=None,
+                 min_interval=None, thresholds=None):
+        if interval is None:
+            interval = float(os.getenv('HEARTBEAT_INTERVAL', 10))
+        if max_interval is None:
+            # The server marks agents offline after 30s without news
+            max_interval = float(os.getenv('HEARTBEAT_MAX_INTERVAL', 25))
+        if jitter is None:
+            jitter = float(os.getenv('HEARTBEAT_JITTER', 0.1))
+        if change_threshold is None:
+            change_threshold = float(os.getenv('HEARTBEAT_CHANGE_THRESHOLD', 5))
+        if min_interval is None:
+            min_interval = float(os.getenv('HEARTBEAT_MIN_INTERVAL', 2))
+        if thresholds is None:
+            thresholds = dict(DEFAULT_THRESHOLDS)
+
+        self.interval = interval
+        self.max_interval = max(max_interval, interval)
+        self.jitter = jitter
+        self.change_threshold = change_threshold
+        self.min_interval = min_interval
+        self.thresholds = thresholds
+        self.check_interval = 1.0  # How often to look at the latest sample while waiting
+
+        self.current_interval = interval
+        self.last_sent = None
+        self.last_sent_at = None
+        self._wake = asyncio.Event()
+
+    def configure(self, interval=None, max_interval=None, thresholds=None):
+        """Apply settings sent by the server"""
+        if interval:
+            self.interval = max(float(interval), self.min_interval)
+        if max_interval:
+            self.max_interval = float(max_interval)
+        self.max_interval = max(self.max_interval, self.interval)
+        if thresholds:
+            self.thresholds.update({key: float(value) for key, value in thresholds.items()})
+        self.current_interval = self.interval
+        self._wake.set()
+
+    def reset(self):
+        """Start over on a new connection"""
+        self.current_interval = self.interval
+        self.last_sent = None
+        self.last_sent_at = None
+
+    def initial_delay(self):
+        """Random offset so agents reconnecting together don't beat in lockstep"""
+        return random.uniform(0, self.interval * self.jitter)
+
+    def record_sent(self, stats):
+        """Update the interval after sending stats"""
+        if self.last_sent is not None and not self._changed(stats) and not self._crossed(stats):
+            # Nothing moved, back off towards max_interval
+            self.current_interval = min(self.current_interval * 2, self.max_interval)
+        else:
+            self.current_interval = self.interval
+        self.last_sent = dict(stats)
+        self.last_sent_at = time.monotonic()
+
+    def _changed(self, stats):
+        return any(
+            abs(stats.get(key, 0) - self.last_sent.get(key, 0)) >= self.change_threshold
+            for key in stats
+            if isinstance(stats.get(key), (int, float))
+        )
+
+    def _crossed(self, stats):
+        return any(
+            (stats.get(key, 0) >= limit) != (self.last_sent.get(key, 0) >= limit)
+            for key, limit in self.thresholds.items()
+            if key in stats
+        )
+
+    async def wait(self, get_stats):
+        """Sleep until the next heartbeat is due, returns why it is due"""
+        spread = self.current_interval * self.jitter
+        delay = self.current_interval + random.uniform(-spread, spread)
+
+        while True:
+            elapsed = time.monotonic() - self.last_sent_at if self.last_sent_at else delay
+            if elapsed >= delay:
+                return 'interval'
+
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=min(self.check_interval, delay - elapsed))
+            except asyncio.TimeoutError:
+                pass
+
+            if self._wake.is_set():
+                # New settings from the server, restart the wait with them
+                self._wake.clear()
+                spread = self.current_interval * self.jitter
+                delay = self.current_interval + random.uniform(-spread, spread)
+                continue
+
+            if self.last_sent is None:
+                continue
+            elapsed = time.monotonic() - self.last_sent_at
+            if elapsed < self.min_interval:
+                continue
+
+            stats = get_stats()
+            if self._crossed(stats):
+                return 'threshold'
+            # While backed off, a real change brings the normal cadence back at once
+            if self.current_interval > self.interval and elapsed >= self.interval and self._changed(stats):
+                return 'change'
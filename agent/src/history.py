@@ -0,0 +1,154 @@
+"""
+Stats history
+Keeps quick stats samples in fixed-size ring buffers at several resolutions
+(1 second, 1 minute, 15 minutes by default). Each slot holds min, max and
+sum per field in flat arrays, so memory is fixed however long the agent runs.
+"""
+import math
+import os
+import threading
+import time
+from array import array
+
+FIELDS = ('cpu_percent', 'memory_percent', 'disk_percent')
+
+# resolution seconds:slots, about an hour, a day and a week
+DEFAULT_TIERS = '1:3600,60:1440,900:672'
+
+
+def parse_tiers(spec):
+    """'1:3600,60:1440' -> [(1, 3600), (60, 1440)], finest first"""
+    tiers = []
+    for part in spec.split(','):
+        resolution, slots = part.strip().split(':')
+        tiers.append((max(int(resolution), 1), max(int(slots), 1)))
+    return sorted(tiers)
+
+
+class _Tier:
+    """Ring of fixed-width time buckets"""
+
+    def __init__(self, resolution, slots, fields):
+        self.resolution = resolution
+        self.slots = slots
+        self.fields = len(fields)
+        self.buckets = array('q', [-1]) * slots  # Bucket number (time // resolution), -1 when empty
+        self.counts = array('I', [0]) * slots
+        # Field-major: value of field f in slot i is at f * slots + i
+        self.mins = array('f', [0.0]) * (slots * self.fields)
+        self.maxs = array('f', [0.0]) * (slots * self.fields)
+        self.sums = array('d', [0.0]) * (slots * self.fields)
+        self.latest = -1  # Newest bucket number written
+
+    def add(self, timestamp, values):
+        bucket = int(timestamp // self.resolution)
+        if bucket < self.latest - self.slots + 1:
+            return  # Older than anything we keep
+        slot = bucket % self.slots
+        fresh = self.buckets[slot] != bucket
+        if fresh:
+            self.buckets[slot] = bucket
+            self.counts[slot] = 0
+        self.counts[slot] += 1
+        self.latest = max(self.latest, bucket)
+
+        for f, value in enumerate(values):
+            i = f * self.slots + slot
+            if fresh:
+                self.mins[i] = self.maxs[i] = value
+                self.sums[i] = value
+            else:
+                self.mins[i] = min(self.mins[i], value)
+                self.maxs[i] = max(self.maxs[i], value)
+                self.sums[i] += value
+
+    @property
+    def oldest(self):
+        """Start time of the oldest bucket still held, None when empty"""
+        if self.latest < 0:
+            return None
+        first = self.latest - self.slots + 1
+        for bucket in range(max(first, 0), self.latest + 1):
+            if self.buckets[bucket % self.slots] == bucket:
+                return bucket * self.resolution
+        return None
+
+    def slots_between(self, start, end):
+        """Slot indexes of the filled buckets in [start, end], oldest first"""
+        if self.latest < 0:
+            return []
+        first = max(int(start // self.resolution), self.latest - self.slots + 1, 0)
+        last = min(int(end // self.resolution), self.latest)
+        return [
+            bucket % self.slots for bucket in range(first, last + 1)
+            if self.buckets[bucket % self.slots] == bucket
+        ]
+
+
+class StatsHistory:
+    """Multi-resolution history of quick stats, safe to feed from the sampler thread"""
+
+    def __init__(self, tiers=None, fields=FIELDS):
+        if tiers is None:
+            tiers = parse_tiers(os.getenv('STATS_HISTORY_TIERS', DEFAULT_TIERS))
+        self.fields = tuple(fields)
+        self.tiers = [_Tier(resolution, slots, self.fields) for resolution, slots in tiers]
+        self._lock = threading.Lock()
+
+    def add(self, timestamp, stats):
+        """Record one sample, every tier rolls it into its current bucket"""
+        values = [float(stats.get(field) or 0.0) for field in self.fields]
+        with self._lock:
+            for tier in self.tiers:
+                tier.add(timestamp, values)
+
+    def _pick_tier(self, start, end, resolution):
+        for tier in self.tiers:
+            if resolution and tier.resolution < resolution:
+                continue
+            # Finest tier whose ring spans the whole range
+            if resolution or tier.resolution * tier.slots >= end - start:
+                return tier
+        return self.tiers[-1]
+
+    def query(self, start=None, end=None, resolution=None, max_points=1000):
+        """Stats between start and end (unix seconds) as min/max/avg columns
+
+        Uses the finest resolution that spans the range unless a coarser one
+        is asked for, and merges neighbouring buckets to stay within max_points.
+        """
+        with self._lock:
+            end = time.time() if end is None else end
+            start = end - 3600 if start is None else start
+            tier = self._pick_tier(start, end, resolution)
+            slots = tier.slots_between(start, end)
+
+            step = max(1, math.ceil(len(slots) / max(max_points or 1, 1)))
+            timestamps = []
+            series = {field: {'min': [], 'max': [], 'avg': []} for field in self.fields}
+            for group_start in range(0, len(slots), step):
+                group = slots[group_start:group_start + step]
+                count = sum(tier.counts[slot] for slot in group)
+                timestamps.append(tier.buckets[group[0]] * tier.resolution)
+                for f, field in enumerate(self.fields):
+                    offset = f * tier.slots
+                    column = series[field]
+                    column['min'].append(round(min(tier.mins[offset + slot] for slot in group), 2))
+                    column['max'].append(round(max(tier.maxs[offset + slot] for slot in group), 2))
+                    column['avg'].append(round(sum(tier.sums[offset + slot] for slot in group) / count, 2))
+
+        return {
+            'start': start,
+            'end': end,
+            'resolution': tier.resolution * step,
+            'timestamps': timestamps,
+            'series': series
+        }
+
+    def describe(self):
+        """Resolution, capacity and oldest sample of each tier"""
+        with self._lock:
+            return [
+                {'resolution': tier.resolution, 'slots': tier.slots, 'oldest': tier.oldest}
+                for tier in self.tiers
+            ]
@@ -0,0 +1,84 @@
+"""
+Per-file JSON store
+Keeps one JSON document per key in a directory, written atomically, for the
+outbox and result cache to survive agent restarts
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JsonStore:
+    """One <key>.json file per entry, an empty directory keeps nothing on disk
+
+    Writes and deletes run in order on one background thread, so callers on
+    the event loop never wait for the disk. Documents must not be changed
+    after they are saved.
+    """
+
+    def __init__(self, directory, label='entry'):
+        self.directory = directory
+        self.label = label  # What an entry is, for warnings
+        self._writer = None  # Created on first write
+
+    def __bool__(self):
+        return bool(self.directory)
+
+    def path(self, key):
+        # Keys (commandIds) come from the server, keep them from escaping the directory
+        safe_key = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in key)
+        return os.path.join(self.directory, f"{safe_key}.json")
+
+    def load(self):
+        """Every readable document, oldest file first; unreadable files are deleted"""
+        if not self.directory or not os.path.isdir(self.directory):
+            return []
+        files = [
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory) if name.endswith('.json')
+        ]
+        documents = []
+        for path in sorted(files, key=os.path.getmtime):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    documents.append(json.load(f))
+            except Exception as e:
+                print(f"⚠ Dropping unreadable {self.label} {path}: {e}")
+                self._remove(path)
+        return documents
+
+    def _submit(self, function, *args):
+        if self._writer is None:
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='jsonstore')
+        return self._writer.submit(function, *args)
+
+    def flush(self):
+        """Wait for the writes queued so far"""
+        if self._writer is not None:
+            self._submit(lambda: None).result()
+
+    def save(self, key, document):
+        """Queue a write of document for key, replacing the previous one in a single step"""
+        if self.directory:
+            self._submit(self._write, key, document)
+
+    def _write(self, key, document):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self.path(key)
+            with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+                json.dump(document, f)
+            os.replace(f"{path}.tmp", path)
+        except Exception as e:
+            print(f"⚠ Could not persist {self.label} {key}: {e}")
+
+    def delete(self, key):
+        """Queue removal of key's file, after any write queued before it"""
+        if self.directory:
+            self._submit(self._remove, self.path(key))
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
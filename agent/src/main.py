@@ -1,15 +1,31 @@
+import time
+STARTED_AT = time.perf_counter()  # Before any other import, startup timings count from here
 import asyncio
+import functools
 import websockets
 import ssl
-import json
-import subprocess
 import uuid
 import os
 import socket
 import sys
-import re
+import threading
 from dotenv import load_dotenv
 from system_info import get_system_info, get_quick_stats
+from telemetry import sampler
+from processes import process_tracker
+from executor import CommandExecutor
+from discovery import DiscoveryCache, discover_server_urls
+from delta import DeltaEncoder
+from heartbeat import HeartbeatScheduler
+from wire import WireCodec, codec_from_hello, handshake_headers
+from reconnect import Backoff, UrlHealth
+from outbox import ResultOutbox
+from metrics import metrics, monitor_event_loop, start_metrics_server
+from transfer import MAX_CHUNK_SIZE, FileTransfers
+from outqueue import HEARTBEAT, OutboundQueue, split_result
+from result_cache import ResultCache, command_fingerprint
+
+IMPORTED_AT = time.perf_counter()
 
 # Hybrid config loading: external .env overrides embedded default
 if os.path.exists('.env'):
@@ -31,374 +47,693 @@ else:
         print("✓ Loading .env from script directory...")
         load_dotenv()
 
-def get_arp_table():
-    """Get list of active IPs from ARP table"""
-    try:
-        result = subprocess.run(['arp', '-a'], capture_output=True, text=True)
-        ips = []
-        
-        # Parse ARP table output
-        for line in result.stdout.split('\n'):
-            # Look for lines with IP addresses (format: 192.168.1.1)
-            match = re.search(r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})', line)
-            if match:
-                ip = match.group(1)
-                # Skip multicast and broadcast addresses
-                if not ip.startswith('224.') and not ip.endswith('.255'):
-                    ips.append(ip)
-        
-        print(f"✓ Found {len(ips)} active hosts via ARP")
-        return ips
-    except Exception as e:
-        print(f"⚠ Could not scan ARP table: {e}")
-        return []
-
-def check_port_open(ip, port=3000, timeout=1):
-    """Check if a port is open on given IP"""
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(timeout)
-        result = sock.connect_ex((ip, port))
-        sock.close()
-        return result == 0
-    except:
-        return False
-
-def get_default_gateway():
-    """Get the default gateway IP address"""
-    try:
-        result = subprocess.run(['ipconfig'], capture_output=True, text=True)
-        # Look for "Default Gateway" line
-        for line in result.stdout.split('\n'):
-            if 'Default Gateway' in line or 'Passerelle par défaut' in line:
-                # Extract IP address
-                match = re.search(r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})', line)
-                if match:
-                    return match.group(1)
-    except Exception as e:
-        print(f"⚠ Could not detect gateway: {e}")
-    return None
-
-def get_local_ip_and_subnet():
-    """Get local IP address and calculate subnet range"""
-    try:
-        # Get local IP by connecting to external address (doesn't actually send data)
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        local_ip = s.getsockname()[0]
-        s.close()
-        
-        # Calculate subnet (assumes /24)
-        parts = local_ip.split('.')
-        subnet_base = f"{parts[0]}.{parts[1]}.{parts[2]}"
-        
-        return local_ip, subnet_base
-    except Exception as e:
-        print(f"⚠ Could not detect local IP: {e}")
-        return None, None
-
-def scan_subnet_for_port(subnet_base, port=3000, timeout=0.3):
-    """Scan subnet for hosts with specific port open"""
-    print(f"→ Scanning subnet {subnet_base}.0/24 for port {port}...")
-    found_hosts = []
-    
-    # Scan common host IPs (1, 2, 10-20, 50, 100-110, 200, 254)
-    scan_range = list(range(1, 21)) + [50, 100, 101, 102, 103, 104, 105, 200, 254]
-    
-    for i in scan_range:
-        ip = f"{subnet_base}.{i}"
-        if check_port_open(ip, port, timeout):
-            print(f"  ✓ Port {port} open on {ip}")
-            found_hosts.append(ip)
-    
-    return found_hosts
-
-def discover_server_urls():
-    """Generate list of server URLs to try, in priority order"""
-    urls = []
-    
-    # 1. Configured URL (highest priority)
-    configured_url = os.getenv('SERVER_URL')
-    if configured_url and configured_url != 'auto':
-        urls.append(configured_url)
-        return urls  # If explicitly configured, only try that
-    
-    print("\n🔍 Starting server discovery...")
-    
-    # 2. Localhost (same machine)
-    print("→ Checking localhost...")
-    urls.append('ws://localhost:3000')
-    urls.append('ws://127.0.0.1:3000')
-    
-    # 3. Default gateway (router/server on network)
-    gateway = get_default_gateway()
-    if gateway and gateway not in ['0.0.0.0', '']:
-        print(f"→ Detected gateway: {gateway}")
-        urls.append(f'ws://{gateway}:3000')
-    
-    # 4. ARP scan - find active hosts on network
-    print("→ Scanning network for active hosts (ARP)...")
-    arp_ips = get_arp_table()
-    
-    # Check port 3000 on discovered hosts
-    arp_found_servers = False
-    if arp_ips:
-        print(f"→ Checking port 3000 on {len(arp_ips)} hosts...")
-        for ip in arp_ips:
-            # Skip already added IPs
-            url = f'ws://{ip}:3000'
-            if url not in urls:
-                # Quick port check before adding
-                if check_port_open(ip, 3000, timeout=0.5):
-                    print(f"  ✓ Port 3000 open on {ip}")
-                    urls.append(url)
-                    arp_found_servers = True
-    
-    # 5. If ARP didn't find servers, try subnet scan
-    if not arp_found_servers:
-        print("→ ARP scan found no servers, trying subnet scan...")
-        local_ip, subnet_base = get_local_ip_and_subnet()
-        if subnet_base:
-            print(f"→ Local IP: {local_ip}")
-            subnet_hosts = scan_subnet_for_port(subnet_base, 3000, timeout=0.3)
-            for ip in subnet_hosts:
-                url = f'ws://{ip}:3000'
-                if url not in urls:
-                    urls.append(url)
-                    arp_found_servers = True
-    
-    # 6. Common server names (DNS)
-    print("→ Trying common DNS names...")
-    urls.append('ws://server.local:3000')
-    urls.append('ws://remote-agent-server:3000')
-    urls.append('ws://remote-agent:3000')
-    
-    # 7. Fallback to common gateway IPs (ONLY if nothing else worked)
-    if not arp_found_servers:
-        print("→ No servers found, trying fallback IPs...")
-        fallback_ips = ['192.168.1.1', '192.168.0.1', '10.0.0.1', '172.16.0.1']
-        for ip in fallback_ips:
-            url = f'ws://{ip}:3000'
-            if url not in urls:
-                urls.append(url)
-    else:
-        print(f"→ Skipping fallback IPs (found {len([u for u in urls if 'ws://' in u and u not in ['ws://localhost:3000', 'ws://127.0.0.1:3000']])} servers via ARP)")
-    
-    print(f"\n✓ Discovery complete: {len(urls)} potential servers found\n")
-    return urls
-
 SERVER_URLS = []  # Will be populated during discovery
 AGENT_TOKEN = os.getenv('AGENT_TOKEN', 'your_secure_token_here')
 AGENT_ID = os.getenv('AGENT_ID', str(uuid.uuid4()))
 AGENT_NICKNAME = os.getenv('AGENT_NICKNAME', socket.gethostname())
 AGENT_TAGS = os.getenv('AGENT_TAGS', '').split(',') if os.getenv('AGENT_TAGS') else []
+# Message types beyond the original protocol, advertised so the server can use them
+CAPABILITIES = ['stream', 'cancel', 'execute_batch', 'file_transfer']
+# Cheap sections sent in agent_info on connect when FAST_START is on
+FAST_START_SECTIONS = ['static', 'memory']
 
 class RemoteAgent:
-    def __init__(self):
+    def __init__(self, agent_id=None, token=None, nickname=None, tags=None):
+        # Identity defaults to the configured agent, the fleet benchmark runs many per process
+        self.agent_id = agent_id or AGENT_ID
+        self.token = token or AGENT_TOKEN
+        self.nickname = nickname or AGENT_NICKNAME
+        self.tags = AGENT_TAGS if tags is None else tags
         self.ws = None
+        self.outqueue = None  # Writer queue of the current connection
         self.running = True
-        self.heartbeat_interval = 10  # seconds
+        self.heartbeat = HeartbeatScheduler()
+        self.codec = WireCodec()  # Plain JSON until the server says otherwise
         self.current_server_url = None
-        self.connection_attempts = {}
+        self.url_health = UrlHealth()
+        self.backoff = Backoff()
+        self.outbox = ResultOutbox()
+        self.results = ResultCache()  # Recent results, so redelivered commands don't run twice
+        self.result_acks = False  # Server confirms results with result_ack
+        self.split_batches = False  # Server stitches split batch_result outputs
+        self.hello_received = asyncio.Event()  # Wire format and result acks are settled
         self.server_urls = []  # Will be populated during discovery
+        self.discovery_cache = DiscoveryCache()
+        self.discovery_task = None  # Full discovery running in the background
+        self.connect_stagger = int(os.getenv('CONNECT_STAGGER_MS', 250)) / 1000
+        # Optional pool of long-lived shells, saves a shell spawn per command
+        pool = None
+        if os.getenv('SHELL_POOL', 'false').lower() == 'true':
+            from shell_pool import ShellPool  # Only loaded when enabled
+            pool = ShellPool()
+        self.executor = CommandExecutor(pool=pool)
+        self.delta_enabled = os.getenv('DELTA_ENCODING', 'true').lower() == 'true'
+        # Connect with a minimal agent_info and send the full inventory after heartbeats start
+        self.fast_start = os.getenv('FAST_START', 'true').lower() == 'true'
+        self.deltas = {'heartbeat': DeltaEncoder(), 'system_info': DeltaEncoder()}
+        self.pending_tasks = set()  # In-flight message handlers
+        self.transfers = FileTransfers(self.send)
+        metrics.register_gauge('commands_active', lambda: self.executor.active_count)
+        metrics.register_gauge('outbox_pending', lambda: len(self.outbox))
+        metrics.register_gauge('result_cache_entries', lambda: len(self.results))
+        metrics.register_gauge('ws_write_buffer_bytes', self.write_buffer_size)
+        metrics.register_gauge('ws_queue_depth', lambda: len(self.outqueue) if self.outqueue else 0)
+        metrics.register_gauge('ws_queue_bytes', lambda: self.outqueue.bytes if self.outqueue else 0)
+
+    @property
+    def auto_discovery(self):
+        return os.getenv('SERVER_URL', 'auto') == 'auto'
+
+    async def connect(self, url):
+        """Open a WebSocket connection to a single server URL"""
+        headers = {
+            'X-Agent-Id': self.agent_id,
+            'X-Agent-Token': self.token,
+            'X-Agent-Nickname': self.nickname,
+            'X-Agent-Tags': ','.join(self.tags)
+        }
+        headers.update(handshake_headers())
+        headers['X-Agent-Capabilities'] = ','.join(CAPABILITIES)
+        
+        # Create SSL context for wss:// connections
+        ssl_context = None
+        if url.startswith('wss://'):
+            ssl_context = ssl.create_default_context()
+            # For self-signed certificates in development, disable verification
+            # In production, use proper certificates and remove this
+            verify_ssl = os.getenv('VERIFY_SSL', 'true').lower() == 'true'
+            if not verify_ssl:
+                ssl_context.check_hostname = False
+                ssl_context.verify_mode = ssl.CERT_NONE
+                print("  ⚠ SSL verification disabled (development mode)")
+        
+        return await asyncio.wait_for(
+            websockets.connect(
+                url, extra_headers=headers, ssl=ssl_context,
+                # Offer permessage-deflate, servers that accept it skip per-message zlib
+                compression='deflate' if os.getenv('WS_PER_MESSAGE_DEFLATE', 'true').lower() == 'true' else None,
+                # Room for the largest file_chunk as base64 in JSON, the 1 MiB default drops the connection
+                max_size=MAX_CHUNK_SIZE * 4 // 3 + 64 * 1024
+            ),
+            timeout=5.0
+        )
+
+    async def connect_first(self, urls):
+        """Race connections to all URLs, keep the first to finish the handshake
+        
+        URLs start in order, each connect_stagger seconds after the previous one
+        or as soon as one fails, so the best ranked servers get a head start.
+        """
+        tasks = {}
+        waiting = list(urls)
+        pending = set()
+        winner = None
+        
+        def start(url):
+            task = asyncio.create_task(self.connect(url))
+            tasks[task] = url
+            return task
+        
+        try:
+            while (pending or waiting) and winner is None:
+                while waiting and (self.connect_stagger <= 0 or not pending):
+                    pending.add(start(waiting.pop(0)))
+                done, pending = await asyncio.wait(
+                    pending, timeout=self.connect_stagger if waiting else None,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    pending.add(start(waiting.pop(0)))
+                for task in done:
+                    url = tasks[task]
+                    if task.exception() is not None:
+                        self.url_health.record_failure(url)
+                        self.discovery_cache.record_failure(url)
+                        if waiting:
+                            pending.add(start(waiting.pop(0)))
+                        e = task.exception()
+                        if isinstance(e, asyncio.TimeoutError):
+                            print(f"✗ Timeout connecting to {url}")
+                        else:
+                            print(f"✗ Failed to connect to {url}: {e}")
+                    elif winner is None:
+                        winner = (url, task.result())
+                    else:
+                        await task.result().close()
+        finally:
+            # Stop the losers, closing any that connected in the meantime
+            for task in pending:
+                task.cancel()
+            for result in await asyncio.gather(*pending, return_exceptions=True):
+                if not isinstance(result, BaseException):
+                    await result.close()
+        
+        return winner
 
     async def discover_and_connect(self):
         """Discover servers and try to connect"""
-        # Run discovery if not already done
-        if not self.server_urls:
-            self.server_urls = discover_server_urls()
+        # Cached servers first, the server almost never moves
+        cached = self.discovery_cache.get_urls() if self.auto_discovery else []
         
-        for url in self.server_urls:
-            # Track attempts per URL
-            if url not in self.connection_attempts:
-                self.connection_attempts[url] = 0
-            
-            self.connection_attempts[url] += 1
-            
-            # Skip URLs that have failed too many times
-            if self.connection_attempts[url] > 3:
-                continue
+        if cached and not self.server_urls:
+            print(f"→ Trying {len(cached)} cached server(s)...")
+            winner = await self.connect_first(cached)
+            if winner:
+                return self.on_connected(*winner)
             
+            # Keep retrying the cache while a full discovery runs in the background
+            if self.discovery_task is None:
+                print("→ Cached servers unreachable, running discovery in the background...")
+                self.discovery_task = asyncio.create_task(discover_server_urls())
+            if not self.discovery_task.done():
+                return False
+        
+        # Run discovery if not already done
+        if not self.server_urls:
+            if self.discovery_task is None:
+                self.discovery_task = asyncio.create_task(discover_server_urls())
             try:
-                print(f"→ Trying to connect to {url}...")
-                headers = {
-                    'X-Agent-Id': AGENT_ID,
-                    'X-Agent-Token': AGENT_TOKEN,
-                    'X-Agent-Nickname': AGENT_NICKNAME,
-                    'X-Agent-Tags': ','.join(AGENT_TAGS)
-                }
-                
-                # Create SSL context for wss:// connections
-                ssl_context = None
-                if url.startswith('wss://'):
-                    ssl_context = ssl.create_default_context()
-                    # For self-signed certificates in development, disable verification
-                    # In production, use proper certificates and remove this
-                    verify_ssl = os.getenv('VERIFY_SSL', 'true').lower() == 'true'
-                    if not verify_ssl:
-                        ssl_context.check_hostname = False
-                        ssl_context.verify_mode = ssl.CERT_NONE
-                        print("  ⚠ SSL verification disabled (development mode)")
-                
-                self.ws = await asyncio.wait_for(
-                    websockets.connect(url, extra_headers=headers, ssl=ssl_context),
-                    timeout=5.0
-                )
-                
-                self.current_server_url = url
-                protocol = "WSS (secure)" if url.startswith('wss://') else "WS (insecure)"
-                print(f"✓ Connected to server at {url} ({protocol})")
-                print(f"  Agent ID: {AGENT_ID}")
-                print(f"  Nickname: {AGENT_NICKNAME}")
-                print(f"  Tags: {', '.join(AGENT_TAGS) if AGENT_TAGS else 'None'}")
-                
-                # Reset attempt counter on successful connection
-                self.connection_attempts[url] = 0
-                return True
-                
-            except asyncio.TimeoutError:
-                print(f"✗ Timeout connecting to {url}")
-            except Exception as e:
-                print(f"✗ Failed to connect to {url}: {e}")
+                self.server_urls = await self.discovery_task
+            finally:
+                self.discovery_task = None
+        
+        # Skip URLs that keep failing until their cooldown is over, unless
+        # that leaves nothing to try and the backoff is the only wait
+        urls = cached + [url for url in self.server_urls if url not in cached]
+        urls = self.url_health.available(urls)
+        if urls:
+            print(f"→ Trying to connect to {len(urls)} server(s) in parallel...")
+            winner = await self.connect_first(urls)
+            if winner:
+                return self.on_connected(*winner)
         
         print(f"✗ Could not connect to any server")
-        print(f"  Tried: {len(self.server_urls)} URLs")
+        print(f"  Tried: {len(urls)} URLs")
         return False
 
-    def execute_command(self, command):
-        """Execute Windows command and return output"""
+    def on_connected(self, url, ws):
+        """Record a successful connection"""
+        self.ws = ws
+        self.current_server_url = url
+        protocol = "WSS (secure)" if url.startswith('wss://') else "WS (insecure)"
+        print(f"✓ Connected to server at {url} ({protocol})")
+        print(f"  Agent ID: {self.agent_id}")
+        print(f"  Nickname: {self.nickname}")
+        print(f"  Tags: {', '.join(self.tags) if self.tags else 'None'}")
+        
+        self.url_health.record_success(url)
+        if self.auto_discovery:
+            self.discovery_cache.record_success(url)
+        return True
+
+    async def run_once(self, command_id, handler, data):
+        """Run handler for a command unless the same command has been seen before
+        
+        A redelivered command (same commandId and command) is answered with the
+        cached result, or left to the run already in progress, which answers
+        both deliveries.
+        """
+        if not command_id:
+            await handler(data)
+            return
+        
+        fingerprint = command_fingerprint(data)
+        cached = self.results.get(command_id, fingerprint)
+        if cached is not None:
+            metrics.inc('duplicate_commands_total')
+            print(f"\n⚠ Command {command_id} already ran, resending its result")
+            await self.send_result(cached)
+            return
+        if not self.results.start(command_id, fingerprint):
+            metrics.inc('duplicate_commands_total')
+            print(f"\n⚠ Command {command_id} is already running, not starting it again")
+            return
+        
         try:
-            # Use cmd.exe for Windows commands
-            result = subprocess.run(
-                command,
-                shell=True,
-                capture_output=True,
-                text=True,
-                timeout=int(os.getenv('COMMAND_TIMEOUT_MS', 30000)) / 1000
-            )
-            
-            output = result.stdout if result.stdout else result.stderr
-            return {
-                'success': result.returncode == 0,
-                'output': output,
-                'returncode': result.returncode
-            }
-        except subprocess.TimeoutExpired:
-            return {
-                'success': False,
-                'output': 'Command timed out',
-                'returncode': -1
-            }
-        except Exception as e:
-            return {
-                'success': False,
-                'output': str(e),
-                'returncode': -1
-            }
+            await handler(data)
+        finally:
+            self.results.finish(command_id, fingerprint)
+
+    async def handle_execute(self, data):
+        """Run a command from the server and send back its result"""
+        command = data['command']
+        command_id = data.get('commandId')  # Get commandId if present
+        require_confirmation = data.get('requireConfirmation', False)
+        
+        print(f"\n→ Command: {command}")
+        if command_id:
+            print(f"  Command ID: {command_id}")
+        
+        if require_confirmation:
+            confirm = await asyncio.to_thread(input, "Execute? (y/n): ")
+            if confirm.lower() != 'y':
+                print("✗ Command cancelled")
+                return
+        
+        # Streaming needs a commandId so the server can stitch chunks together
+        stream = bool(data.get('stream')) and bool(command_id)
+        on_output = self.make_chunk_sender(command_id) if stream else None
+        
+        print("⚙ Executing..." if not stream else "⚙ Executing (streaming output)...")
+        result = await self.executor.execute(
+            command, command_id, timeout=data.get('timeout'), on_output=on_output
+        )
+        
+        if result['success']:
+            print(f"✓ Success:\n{result['output']}")
+        else:
+            print(f"✗ Failed:\n{result['output']}")
+        
+        # Send result back to server with commandId
+        result_message = {
+            'type': 'result',
+            'command': command,
+            'output': result['output'],
+            'success': result['success']
+        }
+        
+        if stream:
+            result_message['streamed'] = True
+            result_message['returncode'] = result['returncode']
+            result_message['chunks'] = on_output.seq
+        
+        # Include commandId if it was provided
+        replay = None
+        if command_id:
+            result_message['commandId'] = command_id
+            if stream:
+                # The chunks are gone once sent, the cache and outbox keep the output collected from them
+                replay = dict(result_message, output=''.join(on_output.parts))
+                del replay['streamed'], replay['chunks']
+            self.results.add(replay or result_message, command_fingerprint(data))
+        
+        await self.send_result(result_message, replay)
+
+    async def handle_execute_batch(self, data):
+        """Run a batch of commands and send back one aggregated result"""
+        commands = data.get('commands') or []
+        batch_id = data.get('batchId') or str(uuid.uuid4())
+        mode = 'parallel' if data.get('mode') == 'parallel' else 'sequential'
+        
+        print(f"\n→ Batch {batch_id}: {len(commands)} command(s), {mode}")
+        for command in commands:
+            print(f"  {command}")
+        
+        if data.get('requireConfirmation', False):
+            confirm = await asyncio.to_thread(input, "Execute batch? (y/n): ")
+            if confirm.lower() != 'y':
+                print("✗ Batch cancelled")
+                return
+        
+        started = time.monotonic()
+        results = await self.executor.execute_batch(
+            commands, batch_id, mode,
+            stop_on_error=data.get('stopOnError', True),
+            concurrency=data.get('concurrency'),
+            timeout=data.get('timeout')
+        )
+        duration_ms = round((time.monotonic() - started) * 1000)
+        success = all(result['success'] for result in results)
+        
+        failed = sum(1 for result in results if not result['success'])
+        if success:
+            print(f"✓ Batch {batch_id} succeeded in {duration_ms}ms")
+        else:
+            print(f"✗ Batch {batch_id}: {failed} of {len(results)} failed or skipped ({duration_ms}ms)")
+        
+        # commandId lets the outbox, result_ack and result cache treat the batch like one result
+        batch_message = {
+            'type': 'batch_result',
+            'batchId': batch_id,
+            'commandId': batch_id,
+            'mode': mode,
+            'success': success,
+            'durationMs': duration_ms,
+            'results': results
+        }
+        self.results.add(batch_message, command_fingerprint(data))
+        await self.send_result(batch_message)
+
+    def make_chunk_sender(self, command_id):
+        """Build an output callback that sends result_chunk messages"""
+        async def send_chunk(stream_name, text):
+            # Take the sequence number before awaiting, stdout and stderr
+            # are pumped concurrently
+            seq = send_chunk.seq
+            send_chunk.seq += 1
+            # Keep what the result cache can hold
+            if send_chunk.kept < self.results.max_output:
+                send_chunk.parts.append(text)
+                send_chunk.kept += len(text)
+            await self.send({
+                'type': 'result_chunk',
+                'commandId': command_id,
+                'stream': stream_name,
+                'seq': seq,
+                'data': text
+            })
+        
+        send_chunk.seq = 0
+        send_chunk.parts = []
+        send_chunk.kept = 0
+        return send_chunk
 
     async def handle_message(self, message):
         """Handle incoming messages from server"""
-        data = json.loads(message)
+        data = self.codec.decode(message)
         
         if data['type'] == 'execute':
-            command = data['command']
-            command_id = data.get('commandId')  # Get commandId if present
-            require_confirmation = data.get('requireConfirmation', False)
-            
-            print(f"\n→ Command: {command}")
-            if command_id:
-                print(f"  Command ID: {command_id}")
-            
-            if require_confirmation:
-                confirm = input("Execute? (y/n): ")
-                if confirm.lower() != 'y':
-                    print("✗ Command cancelled")
-                    return
-            
-            print("⚙ Executing...")
-            result = self.execute_command(command)
-            
-            if result['success']:
-                print(f"✓ Success:\n{result['output']}")
-            else:
-                print(f"✗ Failed:\n{result['output']}")
-            
-            # Send result back to server with commandId
-            result_message = {
-                'type': 'result',
-                'command': command,
-                'output': result['output'],
-                'success': result['success']
-            }
-            
-            # Include commandId if it was provided
-            if command_id:
-                result_message['commandId'] = command_id
-            
-            await self.ws.send(json.dumps(result_message))
+            await self.run_once(data.get('commandId'), self.handle_execute, data)
+        
+        elif data['type'] == 'execute_batch':
+            await self.run_once(data.get('batchId'), self.handle_execute_batch, data)
+        
+        elif data['type'] == 'cancel':
+            command_id = data.get('commandId')
+            if self.executor.cancel(command_id):
+                print(f"✗ Cancelling command {command_id}")
         
         elif data['type'] == 'get_system_info':
             print("\n→ Collecting system information...")
-            system_info = get_system_info()
+            # Optional subset of sections; refresh bypasses the section caches
+            system_info = await asyncio.to_thread(
+                get_system_info, data.get('sections'), 0 if data.get('refresh') else None
+            )
             
-            await self.ws.send(json.dumps({
-                'type': 'system_info',
-                'data': system_info
-            }))
+            if data.get('sections'):
+                # Partial inventories are merged by the server, never delta encoded
+                await self.send({
+                    'type': 'system_info',
+                    'data': system_info
+                })
+            else:
+                await self.send_snapshot('system_info', 'system_info', system_info)
             print("✓ System info sent")
         
+        elif data['type'] == 'hello':
+            # Server picked a wire format from what we offered in the handshake
+            threshold = int(os.getenv('WIRE_COMPRESS_THRESHOLD', 1024))
+            self.codec = codec_from_hello(data, threshold)
+            self.result_acks = bool(data.get('resultAck'))
+            self.split_batches = bool(data.get('splitBatch'))
+            self.transfers.binary = self.codec.encoding == 'msgpack'
+            print(f"✓ Wire format: {self.codec.encoding}" + (f" + {self.codec.compression}" if self.codec.compression else ""))
+            self.hello_received.set()
+        
+        elif data['type'] == 'result_ack':
+            self.outbox.remove(data.get('commandId'))
+        
+        elif data['type'] == 'set_heartbeat':
+            self.heartbeat.configure(
+                data.get('interval'), data.get('maxInterval'), data.get('thresholds')
+            )
+            print(f"✓ Heartbeat interval set to {self.heartbeat.interval}s (max {self.heartbeat.max_interval}s)")
+        
+        elif data['type'] == 'delta_ack':
+            encoder = self.deltas.get(data.get('stream'))
+            if encoder:
+                encoder.ack(data.get('version'))
+        
+        elif data['type'] == 'resync':
+            # Server lost track of a stream, start it again from a full snapshot
+            stream = data.get('stream')
+            if stream in self.deltas:
+                self.deltas[stream].reset()
+            if stream == 'system_info':
+                system_info = await asyncio.to_thread(get_system_info)
+                await self.send_snapshot('system_info', 'system_info', system_info)
+        
+        elif data['type'] == 'file_get':
+            await self.transfers.handle_get(data)
+        
+        elif data['type'] == 'file_put':
+            await self.transfers.handle_put(data)
+        
+        elif data['type'] == 'file_chunk':
+            await self.transfers.handle_chunk(data)
+        
+        elif data['type'] == 'file_ack':
+            self.transfers.handle_ack(data)
+        
+        elif data['type'] == 'file_end':
+            await self.transfers.handle_end(data)
+        
+        elif data['type'] == 'file_cancel':
+            if self.transfers.cancel(data.get('transferId')):
+                print(f"✗ Cancelling transfer {data.get('transferId')}")
+        
+        elif data['type'] == 'get_agent_metrics':
+            await self.send({
+                'type': 'agent_metrics',
+                'data': metrics.snapshot()
+            })
+        
+        elif data['type'] == 'get_stats_history':
+            history = sampler.history
+            if history is None:
+                reply = {'error': 'Stats history is disabled on this agent'}
+            else:
+                reply = await asyncio.to_thread(
+                    history.query, data.get('start'), data.get('end'),
+                    data.get('resolution'), data.get('maxPoints') or 1000
+                )
+                reply['tiers'] = history.describe()
+            await self.send({
+                'type': 'stats_history',
+                'requestId': data.get('requestId'),
+                'data': reply
+            })
+        
         elif data['type'] == 'get_quick_stats':
             stats = get_quick_stats()
             
-            await self.ws.send(json.dumps({
+            await self.send({
                 'type': 'quick_stats',
                 'data': stats
-            }))
+            })
+
+    def dispatch(self, message):
+        """Handle a message in its own task so slow handlers don't block the read loop"""
+        metrics.inc('messages_received_total')
+        metrics.inc('bytes_received_total', len(message))
+        task = asyncio.create_task(self._handle_safely(message))
+        self.pending_tasks.add(task)
+        task.add_done_callback(self.pending_tasks.discard)
 
-    async def send_heartbeat(self):
-        """Send periodic heartbeat with quick stats"""
+    async def _handle_safely(self, message):
+        try:
+            await self.handle_message(message)
+        except websockets.exceptions.ConnectionClosed:
+            print("✗ Could not send response, connection closed")
+        except Exception as e:
+            print(f"✗ Error handling message: {e}")
+
+    async def send(self, message):
+        """Queue a message for the writer task and wait until it is sent"""
+        if self.outqueue is None:
+            raise websockets.exceptions.ConnectionClosed(None, None)
+        await self.outqueue.put(message)
+
+    def write_buffer_size(self):
+        """Bytes the transport has not written to the socket yet"""
+        transport = getattr(self.ws, 'transport', None)
+        return transport.get_write_buffer_size() if transport else 0
+
+    async def send_result(self, message, replay=None):
+        """Send a command result, keeping it in the outbox until it is delivered
+        
+        replay is what to resend if this send is lost, message itself by default.
+        """
+        command_id = message.get('commandId')
+        if command_id:
+            self.outbox.add(replay or message)
+        
+        try:
+            with metrics.timer('result_send_seconds'):
+                # Large outputs go out in pieces so other messages can pass in between
+                for piece in split_result(message, batches=self.split_batches):
+                    await self.send(piece)
+        except websockets.exceptions.ConnectionClosed:
+            if command_id:
+                print(f"⚠ Connection down, result for {command_id} kept for replay")
+                return
+            raise
+        
+        # Servers that don't acknowledge results count a successful send as delivery
+        if command_id and not self.result_acks:
+            self.outbox.remove(command_id)
+
+    async def flush_outbox(self, pending):
+        """Replay results that were undelivered when the connection started
+        
+        Waits for the server's hello first so replays use the negotiated
+        encoding, servers that never send one get plain JSON after a while.
+        Results sent on this connection in the meantime are not replayed.
+        """
+        try:
+            await asyncio.wait_for(self.hello_received.wait(), float(os.getenv('HELLO_WAIT_SECONDS', 5)))
+        except asyncio.TimeoutError:
+            pass
+        # Skip anything acknowledged or sent again while we waited
+        pending = [message for message in pending if self.outbox.get(message['commandId']) is message]
+        if pending:
+            print(f"→ Replaying {len(pending)} undelivered result(s)...")
+        try:
+            for message in pending:
+                await self.send_result(message)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        except Exception as e:
+            print(f"✗ Could not replay results: {e}")
+
+    def snapshot_message(self, message_type, stream, data):
+        """Build a snapshot message, as a delta when the server supports it"""
+        if not self.delta_enabled:
+            return {'type': message_type, 'data': data}
+        
+        fields = self.deltas[stream].encode(data)
+        if 'patch' in fields:
+            message = {'type': 'delta', 'stream': stream, 'messageType': message_type}
+        else:
+            message = {'type': message_type}
+        message.update(fields)
+        return message
+
+    async def send_snapshot(self, message_type, stream, data):
+        """Send a snapshot message, as a delta when the server supports it"""
+        await self.send(self.snapshot_message(message_type, stream, data))
+
+    async def send_heartbeat(self, immediate=False):
+        """Send heartbeats with quick stats on the adaptive schedule"""
+        self.heartbeat.reset()
+        if not immediate:
+            await asyncio.sleep(self.heartbeat.initial_delay())
         while self.running and self.ws:
             try:
                 stats = get_quick_stats()
-                await self.ws.send(json.dumps({
-                    'type': 'heartbeat',
-                    'data': stats
-                }))
-                await asyncio.sleep(self.heartbeat_interval)
+                # Encoded when the writer gets to it, a newer heartbeat replaces
+                # one still waiting behind a slow link. The very first one is
+                # waited for, the startup milestone is when it is on the wire
+                first = 'startup_first_heartbeat_seconds' not in metrics.gauges
+                await self.outqueue.put(
+                    functools.partial(self.snapshot_message, 'heartbeat', 'heartbeat', stats),
+                    HEARTBEAT, key='heartbeat', wait=first
+                )
+                self.heartbeat.record_sent(stats)
+                if first:
+                    record_startup('startup_first_heartbeat_seconds', 'First heartbeat')
+                await self.heartbeat.wait(get_quick_stats)
             except Exception as e:
                 print(f"Heartbeat error: {e}")
                 break
 
+    async def send_inventory(self):
+        """Send the full inventory after a minimal agent_info, the server merges it in"""
+        try:
+            system_info = await asyncio.to_thread(get_system_info)
+            await self.send_snapshot('system_info', 'system_info', system_info)
+            record_startup('startup_inventory_seconds', 'Full inventory sent')
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        except Exception as e:
+            print(f"✗ Could not send inventory: {e}")
+
     async def run(self):
         """Main agent loop"""
         while self.running:
             if not await self.discover_and_connect():
-                print("Retrying in 5 seconds...")
-                await asyncio.sleep(5)
+                metrics.inc('connect_failures_total')
+                delay = self.backoff.next_delay()
+                print(f"Retrying in {delay:.1f} seconds...")
+                await asyncio.sleep(delay)
                 continue
             
+            metrics.inc('connects_total')
+            record_startup('startup_connected_seconds', 'Connected')
+            connected_at = time.monotonic()
+            heartbeat_task = None
+            inventory_task = None
+            outbox_task = None
             try:
+                # New connection: plain JSON until the server's hello, and the
+                # server has no base for any delta stream
+                self.codec = WireCodec()
+                self.result_acks = False
+                self.split_batches = False
+                self.hello_received.clear()
+                self.transfers.binary = False
+                for encoder in self.deltas.values():
+                    encoder.reset()
+                # Only the writer task touches the socket from here on
+                self.outqueue = OutboundQueue(self.ws, lambda message: self.codec.encode(message))
+                self.outqueue.start()
+                
                 # Send initial system info on connect
-                system_info = get_system_info()
-                await self.ws.send(json.dumps({
-                    'type': 'agent_info',
-                    'data': system_info
-                }))
+                sections = FAST_START_SECTIONS if self.fast_start else None
+                system_info = await asyncio.to_thread(get_system_info, sections)
+                await self.send_snapshot('agent_info', 'system_info', system_info)
+                if not self.fast_start:
+                    record_startup('startup_inventory_seconds', 'Full inventory sent')
+                
+                # Results that finished while we were disconnected, once the
+                # read loop below has handled the server's hello. Taken now,
+                # before this connection sends any result of its own
+                outbox_task = asyncio.create_task(self.flush_outbox(self.outbox.pending()))
                 
                 # Start heartbeat task
-                heartbeat_task = asyncio.create_task(self.send_heartbeat())
+                heartbeat_task = asyncio.create_task(self.send_heartbeat(immediate=self.fast_start))
+                if self.fast_start:
+                    inventory_task = asyncio.create_task(self.send_inventory())
                 
                 async for message in self.ws:
-                    await self.handle_message(message)
-                    
-                # Cancel heartbeat when connection closes
-                heartbeat_task.cancel()
+                    self.dispatch(message)
+                print("✗ Connection closed, reconnecting...")
             except websockets.exceptions.ConnectionClosed:
                 print("✗ Connection lost, reconnecting...")
-                await asyncio.sleep(5)
             except Exception as e:
                 print(f"✗ Error: {e}")
-                await asyncio.sleep(5)
+            finally:
+                # Cancel heartbeat when connection closes
+                if heartbeat_task:
+                    heartbeat_task.cancel()
+                if inventory_task:
+                    inventory_task.cancel()
+                if outbox_task:
+                    outbox_task.cancel()
+                self.transfers.reset()
+                if self.outqueue:
+                    self.outqueue.close()
+            
+            # Only a connection that stayed up counts as recovered, a server
+            # that accepts and drops us right away keeps backing off
+            if time.monotonic() - connected_at >= 30:
+                self.backoff.reset()
+            metrics.inc('reconnects_total')
+            delay = self.backoff.next_delay()
+            print(f"Reconnecting in {delay:.1f} seconds...")
+            await asyncio.sleep(delay)
+
+def record_startup(name, label):
+    """Record how long after start a milestone was first reached"""
+    if name in metrics.gauges:
+        return
+    elapsed = time.perf_counter() - STARTED_AT
+    metrics.set(name, round(elapsed, 3))
+    print(f"✓ {label} {elapsed:.2f}s after start")
+
+async def serve(agent):
+    """Run the agent together with the process-wide instrumentation"""
+    # Keep a reference, the loop only holds tasks weakly
+    lag_monitor = asyncio.create_task(monitor_event_loop())
+    try:
+        await start_metrics_server()
+    except OSError as e:
+        print(f"⚠ Metrics endpoint unavailable: {e}")
+    
+    try:
+        await agent.run()
+    finally:
+        lag_monitor.cancel()
 
 def main():
     print("=" * 60)
@@ -410,16 +745,23 @@ def main():
     
     configured_url = os.getenv('SERVER_URL', 'auto')
     if configured_url == 'auto':
-        print(f"Discovery: Enabled (ARP scan + port check)")
+        print(f"Discovery: Enabled (ARP + parallel subnet scan)")
     else:
         print(f"Discovery: Disabled (using {configured_url})")
     
     print("=" * 60)
     
+    metrics.set('startup_imports_seconds', round(IMPORTED_AT - STARTED_AT, 3))
+    
+    # Start sampling right away so the first heartbeat has a real CPU figure
+    sampler.start()
+    # Prime per-process CPU counters so the first inventory ranks correctly
+    threading.Thread(target=process_tracker.snapshot, name='process-prime', daemon=True).start()
+    
     agent = RemoteAgent()
     
     try:
-        asyncio.run(agent.run())
+        asyncio.run(serve(agent))
     except KeyboardInterrupt:
         print("\n✓ Agent stopped")
 
@@ -0,0 +1,254 @@
+"""
+Agent self-instrumentation
+Counters, gauges and fixed-bucket latency histograms kept in memory, sent
+to the server as agent_metrics and optionally served as Prometheus text
+"""
+import asyncio
+import bisect
+import math
+import os
+import threading
+import time
+
+# Seconds; covers sub-millisecond stats reads up to slow commands
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+# name -> help text for the Prometheus endpoint
+DESCRIPTIONS = {
+    'event_loop_lag_seconds': 'How late the event loop woke up for a timer',
+    'event_loop_last_lag_seconds': 'Most recent event loop lag',
+    'command_queue_seconds': 'Time commands waited for a free execution slot',
+    'command_spawn_seconds': 'Time to start the command process',
+    'command_run_seconds': 'Time from process start to exit',
+    'result_send_seconds': 'Time to hand a result to the WebSocket',
+    'system_info_seconds': 'Time spent collecting system info',
+    'quick_stats_seconds': 'Time spent reading quick stats',
+    'discovery_seconds': 'Time spent on full server discovery',
+    'connects_total': 'Successful server connections',
+    'connect_failures_total': 'Connection rounds where no server answered',
+    'reconnects_total': 'Connections that ended and were retried',
+    'messages_sent_total': 'WebSocket messages sent',
+    'messages_received_total': 'WebSocket messages received',
+    'bytes_sent_total': 'WebSocket payload bytes sent',
+    'bytes_received_total': 'WebSocket payload bytes received',
+    'ws_queue_depth': 'Messages waiting in the outbound queue',
+    'ws_queue_bytes': 'Encoded bytes waiting in the outbound queue',
+    'ws_queue_seconds': 'Time messages waited in the outbound queue',
+    'ws_messages_coalesced_total': 'Queued heartbeats replaced by a newer one',
+    'ws_backpressure_waits_total': 'Times a producer waited for queue space',
+    'ws_write_buffer_bytes': 'Bytes buffered in the WebSocket transport',
+    'commands_active': 'Commands queued or running',
+    'outbox_pending': 'Results waiting for the server to acknowledge them',
+    'result_cache_entries': 'Recent results kept for redelivered commands',
+    'duplicate_commands_total': 'Redelivered commands answered without running them again',
+    'startup_imports_seconds': 'Agent start to modules imported',
+    'startup_connected_seconds': 'Agent start to first server connection',
+    'startup_first_heartbeat_seconds': 'Agent start to first heartbeat sent',
+    'startup_inventory_seconds': 'Agent start to full inventory sent'
+}
+
+
+def _finite(value):
+    """JSON has no inf or nan, report them as unknown"""
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+class Histogram:
+    """Per-bucket counts plus sum and count, buckets are upper bounds"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation
+
+        Observations past the last bucket report that bucket's bound, like
+        Prometheus does, so the value stays a plain JSON number.
+        """
+        if not self.count:
+            return None
+        rank = math.ceil(q * self.count)
+        seen = 0
+        for index, count in enumerate(self.counts[:-1]):
+            seen += count
+            if seen >= rank:
+                return self.buckets[index]
+        return self.buckets[-1]
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': _finite(round(self.sum, 6)),
+            'buckets': dict(zip([*map(str, self.buckets), '+Inf'], self.counts)),
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99)
+        }
+
+
+class AgentMetrics:
+    """Registry of the agent's metrics, safe to update from worker threads"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.gauge_functions = {}  # name -> callable evaluated when read
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def add(self, name, value):
+        with self._lock:
+            self.gauges[name] = self.gauges.get(name, 0) + value
+
+    def register_gauge(self, name, function):
+        """Gauge read from function() every time metrics are collected"""
+        self.gauge_functions[name] = function
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def timer(self, name):
+        """Observe how long the with-block took"""
+        return _Timer(self, name)
+
+    def _read_gauges(self):
+        gauges = dict(self.gauges)
+        for name, function in list(self.gauge_functions.items()):
+            try:
+                gauges[name] = function()
+            except Exception:
+                pass
+        return gauges
+
+    def snapshot(self):
+        """All metrics as a JSON-friendly dict, without inf or nan values"""
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {name: histogram.to_dict() for name, histogram in self.histograms.items()}
+        return {
+            'uptime': round(time.time() - self.started, 1),
+            'counters': counters,
+            'gauges': {name: _finite(value) for name, value in self._read_gauges().items()},
+            'histograms': histograms
+        }
+
+    def prometheus(self, prefix='agent_'):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+
+        def header(name, kind):
+            if name in DESCRIPTIONS:
+                lines.append(f"# HELP {prefix}{name} {DESCRIPTIONS[name]}")
+            lines.append(f"# TYPE {prefix}{name} {kind}")
+
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = [
+                (name, histogram.buckets, list(histogram.counts), histogram.sum, histogram.count)
+                for name, histogram in sorted(self.histograms.items())
+            ]
+
+        for name, value in counters:
+            header(name, 'counter')
+            lines.append(f"{prefix}{name} {value}")
+        for name, value in sorted(self._read_gauges().items()):
+            header(name, 'gauge')
+            lines.append(f"{prefix}{name} {value}")
+        for name, buckets, counts, total, count in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip([*map(str, buckets), '+Inf'], counts):
+                cumulative += bucket_count
+                lines.append(f'{prefix}{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f"{prefix}{name}_sum {total}")
+            lines.append(f"{prefix}{name}_count {count}")
+        return '\n'.join(lines) + '\n'
+
+
+class _Timer:
+    __slots__ = ('registry', 'name', 'start')
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.registry.observe(self.name, time.perf_counter() - self.start)
+
+
+metrics = AgentMetrics()
+
+
+async def monitor_event_loop(interval=None):
+    """Measure how late the loop wakes up from a sleep, for as long as it runs"""
+    if interval is None:
+        interval = int(os.getenv('METRICS_LAG_INTERVAL_MS', 500)) / 1000
+
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(loop.time() - start - interval, 0.0)
+        metrics.set('event_loop_last_lag_seconds', round(lag, 6))
+        metrics.observe('event_loop_lag_seconds', lag)
+
+
+async def _handle_scrape(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=5)
+        path = request.split(b' ')[1] if request.count(b' ') >= 2 else b''
+        if path.split(b'?')[0] == b'/metrics':
+            status, body = '200 OK', metrics.prometheus().encode()
+        else:
+            status, body = '404 Not Found', b'Not found\n'
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(port=None, host=None):
+    """Serve GET /metrics as Prometheus text, returns None when METRICS_PORT is unset"""
+    if port is None:
+        port = os.getenv('METRICS_PORT', '')
+    if host is None:
+        # Local only by default, metrics name commands and hosts
+        host = os.getenv('METRICS_HOST', '127.0.0.1')
+    if not port:
+        return None
+
+    server = await asyncio.start_server(_handle_scrape, host, int(port))
+    print(f"✓ Metrics endpoint: http://{host}:{port}/metrics")
+    return server
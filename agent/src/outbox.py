@@ -0,0 +1,63 @@
+"""
+Result outbox
+Keeps command results until the server has them, so results of commands
+that finish while the connection is down are replayed after reconnect
+"""
+import os
+from collections import OrderedDict
+
+from jsonstore import JsonStore
+
+
+class ResultOutbox:
+    """Bounded store of unsent result messages keyed by commandId
+
+    With a directory configured each result is also written to its own file,
+    so pending results survive an agent restart.
+    """
+
+    def __init__(self, directory=None, max_entries=None):
+        if directory is None:
+            directory = os.getenv('OUTBOX_DIR', '')
+        if max_entries is None:
+            max_entries = int(os.getenv('OUTBOX_MAX_ENTRIES', 100))
+
+        self.store = JsonStore(directory, 'result')  # Empty directory keeps the outbox in memory only
+        self.max_entries = max(1, max_entries)
+        self.entries = OrderedDict()
+        self._load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _load(self):
+        for message in self.store.load():
+            self.entries[message['commandId']] = message
+        self._trim()
+
+    def _trim(self):
+        while len(self.entries) > self.max_entries:
+            command_id, _ = self.entries.popitem(last=False)
+            print(f"⚠ Outbox full, dropping oldest result {command_id}")
+            self.store.delete(command_id)
+
+    def add(self, message):
+        """Keep a result message until remove() is called for its commandId"""
+        command_id = message['commandId']
+        self.entries[command_id] = message
+        self.entries.move_to_end(command_id)
+        self.store.save(command_id, message)
+        self._trim()
+
+    def remove(self, command_id):
+        """The server has the result, forget it"""
+        if self.entries.pop(command_id, None) is not None:
+            self.store.delete(command_id)
+
+    def get(self, command_id):
+        """Result waiting for delivery under command_id, or None"""
+        return self.entries.get(command_id)
+
+    def pending(self):
+        """Results still waiting for delivery, oldest first"""
+        return list(self.entries.values())
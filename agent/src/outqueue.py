@@ -0,0 +1,237 @@
+"""
+Outbound message queue
+A single writer task per connection owns the WebSocket and drains a
+priority queue: control messages first, then heartbeats, results and bulk
+file data. A queued heartbeat is replaced by a newer one, and producers
+wait once the queued bytes pass a budget.
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import time
+
+from websockets.exceptions import ConnectionClosed
+
+from metrics import metrics
+
+CONTROL = 0
+HEARTBEAT = 1
+NORMAL = 2
+BULK = 3
+
+# Message type -> priority, anything not listed is NORMAL
+PRIORITIES = {
+    'file_ack': CONTROL,
+    'file_put_ready': CONTROL,
+    'file_put_done': CONTROL,
+    'file_error': CONTROL,
+    'heartbeat': HEARTBEAT,
+    # Meta, chunks and end share a priority so they stay in order
+    'file_meta': BULK,
+    'file_chunk': BULK,
+    'file_end': BULK
+}
+
+
+def priority_of(message):
+    """Queue priority for a message, deltas take the priority of what they encode"""
+    message_type = message.get('messageType') if message.get('type') == 'delta' else message.get('type')
+    return PRIORITIES.get(message_type, NORMAL)
+
+
+def _pieces(key, output, piece_size):
+    return [
+        {
+            'type': 'result_chunk',
+            'commandId': key,
+            'stream': 'stdout',
+            'seq': seq,
+            'data': output[start:start + piece_size],
+            'split': True  # Not live output, the server keeps all of it
+        }
+        for seq, start in enumerate(range(0, len(output), piece_size))
+    ]
+
+
+def split_result(message, piece_size=None, batches=False):
+    """Split a result with a large output into result_chunk pieces and a final result
+
+    Uses the streaming protocol, the server stitches the pieces back together.
+    With batches (the server's hello allows it), each long output of a
+    batch_result goes out the same way, keyed <commandId>#<index>.
+    Anything else comes back as a one-item list.
+    """
+    if piece_size is None:
+        piece_size = int(os.getenv('OUTBOUND_PIECE_SIZE', 64 * 1024))
+    piece_size = max(piece_size, 1024)
+
+    if not message.get('commandId'):
+        return [message]
+
+    if message.get('type') == 'result':
+        output = message.get('output')
+        if message.get('streamed') or not isinstance(output, str) or len(output) <= piece_size:
+            return [message]
+        pieces = _pieces(message['commandId'], output, piece_size)
+        return pieces + [dict(message, output='', streamed=True, chunks=len(pieces))]
+
+    if message.get('type') == 'batch_result' and batches:
+        pieces = []
+        results = []
+        for index, result in enumerate(message.get('results') or []):
+            output = result.get('output')
+            if isinstance(output, str) and len(output) > piece_size:
+                result_pieces = _pieces(f"{message['commandId']}#{index}", output, piece_size)
+                pieces += result_pieces
+                result = dict(result, output='', streamed=True, chunks=len(result_pieces))
+            results.append(result)
+        if pieces:
+            return pieces + [dict(message, results=results)]
+
+    return [message]
+
+
+class _Item:
+    __slots__ = ('message', 'frame', 'size', 'key', 'future', 'dropped', 'queued_at')
+
+    def __init__(self, message, frame, size, key, future):
+        self.message = message
+        self.frame = frame
+        self.size = size
+        self.key = key
+        self.future = future
+        self.dropped = False
+        self.queued_at = time.perf_counter()
+
+
+class OutboundQueue:
+    """Priority queue for one connection, drained by a single writer task"""
+
+    def __init__(self, ws, encode, budget=None):
+        if budget is None:
+            budget = int(os.getenv('OUTBOUND_QUEUE_BYTES', 4 * 1024 * 1024))
+
+        self.ws = ws
+        self.encode = encode  # message -> frame in the current wire format
+        self.budget = max(budget, 1)
+        self.bytes = 0  # Encoded bytes queued and not yet written
+        self._heap = []
+        self._keyed = {}  # key -> waiting item that a newer put replaces
+        self._seq = itertools.count()
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self._error = None
+        self._task = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def start(self):
+        self._task = asyncio.create_task(self._writer())
+        return self._task
+
+    async def put(self, message, priority=None, key=None, wait=True):
+        """Queue a message, or a callable that builds it when its turn comes
+
+        With wait, returns once the message is on the WebSocket and raises
+        ConnectionClosed if it never gets there. A keyed message replaces a
+        waiting one with the same key.
+        """
+        if self._error:
+            raise self._error
+        if priority is None:
+            priority = priority_of(message)
+
+        frame = None
+        size = 0
+        if not callable(message):
+            frame = self.encode(message)
+            # Control messages skip the budget, they are what unblocks the other side
+            if priority > CONTROL:
+                size = len(frame)
+                await self._reserve(size)
+
+        future = asyncio.get_running_loop().create_future() if wait else None
+        item = _Item(message, frame, size, key, future)
+        if key is not None:
+            previous = self._keyed.get(key)
+            if previous:
+                self._drop(previous)
+                metrics.inc('ws_messages_coalesced_total')
+            self._keyed[key] = item
+        heapq.heappush(self._heap, (priority, next(self._seq), item))
+        self._ready.set()
+
+        if future:
+            await future
+
+    async def _reserve(self, size):
+        # A message bigger than the whole budget still goes out once the queue is empty
+        while self.bytes and self.bytes + size > self.budget:
+            metrics.inc('ws_backpressure_waits_total')
+            self._space.clear()
+            await self._space.wait()
+            if self._error:
+                raise self._error
+        self.bytes += size
+
+    def _release(self, size):
+        if size:
+            self.bytes -= size
+            self._space.set()
+
+    def _drop(self, item):
+        item.dropped = True
+        self._release(item.size)
+        if item.future and not item.future.done():
+            item.future.set_result(None)  # Superseded counts as delivered
+
+    async def _writer(self):
+        while True:
+            while not self._heap:
+                self._ready.clear()
+                await self._ready.wait()
+            _, _, item = heapq.heappop(self._heap)
+            if item.dropped:
+                continue
+            if item.key is not None and self._keyed.get(item.key) is item:
+                del self._keyed[item.key]
+
+            try:
+                frame = item.frame if item.frame is not None else self.encode(item.message())
+            except Exception as e:
+                print(f"✗ Could not encode queued message: {e}")
+                if item.future and not item.future.done():
+                    item.future.set_exception(e)
+                continue
+
+            try:
+                await self.ws.send(frame)
+            except Exception as e:
+                # The connection is unusable, whatever the reason
+                if item.future and not item.future.done():
+                    item.future.set_exception(e)
+                self.close(e)
+                return
+            self._release(item.size)
+
+            metrics.inc('messages_sent_total')
+            # Text frames are counted in characters, close enough for ASCII JSON
+            metrics.inc('bytes_sent_total', len(frame))
+            metrics.observe('ws_queue_seconds', time.perf_counter() - item.queued_at)
+            if item.future and not item.future.done():
+                item.future.set_result(None)
+
+    def close(self, error=None):
+        """Connection gone: stop the writer and fail everything still queued"""
+        self._error = error or ConnectionClosed(None, None)
+        if self._task and self._task is not asyncio.current_task():
+            self._task.cancel()
+        for _, _, item in self._heap:
+            if item.future and not item.future.done():
+                item.future.set_exception(self._error)
+        self._heap.clear()
+        self._keyed.clear()
+        self.bytes = 0
+        self._space.set()
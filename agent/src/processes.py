@@ -0,0 +1,115 @@
+"""
+Top process tracking
+Keeps psutil.Process handles between calls so per-process CPU percentages
+are measured over a real interval instead of always reading 0
+"""
+import heapq
+import os
+import threading
+import time
+
+import psutil
+
+# Ranking key -> field in each process row
+RANK_FIELDS = {
+    'cpu': 'cpu',
+    'memory': 'memory',
+    'io': 'io',
+    'threads': 'threads'
+}
+
+
+class ProcessTracker:
+    """Persistent process table with top-N selection"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._procs = {}     # pid -> psutil.Process
+        self._io_totals = {}  # pid -> (read + write bytes, timestamp)
+
+    def _sync(self):
+        """Add new PIDs and drop dead or reused ones"""
+        pids = set(psutil.pids())
+
+        for pid in list(self._procs):
+            if pid not in pids:
+                del self._procs[pid]
+                self._io_totals.pop(pid, None)
+
+        for pid in pids:
+            proc = self._procs.get(pid)
+            if proc is not None and proc.is_running():
+                continue
+            try:
+                proc = psutil.Process(pid)
+                # First call only primes the counter, it always returns 0
+                proc.cpu_percent(None)
+                self._procs[pid] = proc
+                self._io_totals.pop(pid, None)
+            except psutil.Error:
+                self._procs.pop(pid, None)
+
+    def snapshot(self, with_io=False):
+        """Get one row per live process"""
+        with self._lock:
+            self._sync()
+            now = time.monotonic()
+            rows = []
+            for pid, proc in list(self._procs.items()):
+                try:
+                    with proc.oneshot():
+                        row = {
+                            'pid': pid,
+                            'name': proc.name(),
+                            'cpu': proc.cpu_percent(None) or 0,
+                            'memory': proc.memory_percent() or 0,
+                            'threads': proc.num_threads()
+                        }
+                        if with_io:
+                            row['io'] = self._io_rate(pid, proc, now)
+                    rows.append(row)
+                except (psutil.NoSuchProcess, psutil.ZombieProcess):
+                    del self._procs[pid]
+                    self._io_totals.pop(pid, None)
+                except psutil.AccessDenied:
+                    pass
+            return rows
+
+    def _io_rate(self, pid, proc, now):
+        """Bytes per second read and written since the previous sample"""
+        try:
+            counters = proc.io_counters()
+        except (psutil.AccessDenied, AttributeError):
+            return 0
+        total = counters.read_bytes + counters.write_bytes
+        previous = self._io_totals.get(pid)
+        self._io_totals[pid] = (total, now)
+        if previous is None or now <= previous[1]:
+            return 0
+        return round((total - previous[0]) / (now - previous[1]))
+
+    def top(self, limit=10, keys=('cpu', 'memory')):
+        """Get the top processes for each ranking key, e.g. {'by_cpu': [...]}"""
+        keys = [key for key in keys if key in RANK_FIELDS]
+        rows = self.snapshot(with_io='io' in keys)
+
+        result = {}
+        for key in keys:
+            field = RANK_FIELDS[key]
+            # Partial selection, no need to sort thousands of rows
+            result[f'by_{key}'] = heapq.nlargest(limit, rows, key=lambda row: row.get(field, 0))
+        return result
+
+
+def get_rank_keys():
+    """Ranking keys from TOP_PROCESSES_KEYS, always including cpu and memory"""
+    keys = ['cpu', 'memory']
+    for key in os.getenv('TOP_PROCESSES_KEYS', '').split(','):
+        key = key.strip()
+        if key and key not in keys:
+            keys.append(key)
+    return keys
+
+
+# Shared tracker for the whole agent
+process_tracker = ProcessTracker()
@@ -0,0 +1,82 @@
+"""
+Reconnect helpers
+Jittered exponential backoff and per-URL health that recovers over time
+"""
+import os
+import random
+import time
+
+
+class Backoff:
+    """Exponential backoff with full jitter"""
+
+    def __init__(self, base=None, maximum=None, factor=2):
+        if base is None:
+            base = float(os.getenv('RECONNECT_BASE_DELAY', 1))
+        if maximum is None:
+            maximum = float(os.getenv('RECONNECT_MAX_DELAY', 60))
+
+        self.base = base
+        self.maximum = maximum
+        self.factor = factor
+        self.attempts = 0
+
+    def next_delay(self):
+        """Delay before the next attempt, spread over [0, cap] so agents don't retry in waves"""
+        cap = min(self.maximum, self.base * self.factor ** self.attempts)
+        self.attempts += 1
+        return random.uniform(0, cap)
+
+    def reset(self):
+        self.attempts = 0
+
+
+class UrlHealth:
+    """Tracks connection failures per URL
+
+    A URL that keeps failing is rested for a cooldown that doubles with each
+    failure, then tried again. Failures are forgotten one at a time every
+    recovery period, so no URL is blacklisted for the life of the process.
+    The cooldown never outlasts the reconnect backoff cap.
+    """
+
+    def __init__(self, tolerance=3, cooldown=None, max_cooldown=None, recovery=300):
+        if cooldown is None:
+            cooldown = float(os.getenv('URL_COOLDOWN_SECONDS', 30))
+        if max_cooldown is None:
+            max_cooldown = float(os.getenv('URL_MAX_COOLDOWN_SECONDS', 600))
+            max_cooldown = min(max_cooldown, float(os.getenv('RECONNECT_MAX_DELAY', 60)))
+
+        self.tolerance = tolerance
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.recovery = recovery
+        self.entries = {}  # url -> {'failures': n, 'last_failure': ts}
+
+    def failures(self, url, now=None):
+        """Failure count after recovery has been applied"""
+        entry = self.entries.get(url)
+        if entry is None:
+            return 0
+        now = time.monotonic() if now is None else now
+        recovered = int((now - entry['last_failure']) // self.recovery)
+        return max(entry['failures'] - recovered, 0)
+
+    def is_available(self, url):
+        now = time.monotonic()
+        failures = self.failures(url, now)
+        if failures <= self.tolerance:
+            return True
+        cooldown = min(self.cooldown * 2 ** (failures - self.tolerance - 1), self.max_cooldown)
+        return now - self.entries[url]['last_failure'] >= cooldown
+
+    def available(self, urls):
+        """URLs not cooling down, or all of them when that would leave none to try"""
+        return [url for url in urls if self.is_available(url)] or list(urls)
+
+    def record_failure(self, url):
+        now = time.monotonic()
+        self.entries[url] = {'failures': self.failures(url, now) + 1, 'last_failure': now}
+
+    def record_success(self, url):
+        self.entries.pop(url, None)
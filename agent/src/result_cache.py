@@ -0,0 +1,123 @@
+"""
+Result cache
+Remembers recent command results by commandId, so a command the server
+delivers again is answered from the cache or left to the run already in
+progress instead of being executed twice
+"""
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+from jsonstore import JsonStore
+
+
+def command_fingerprint(data):
+    """Hash of what a delivery asks to run: a batch's command list or the command"""
+    payload = data.get('commands') if 'commands' in data else data.get('command')
+    return hashlib.sha256(json.dumps(payload).encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """LRU of result messages keyed by commandId, entries expire after ttl seconds
+
+    A delivery only counts as a duplicate when its command fingerprint matches
+    too, so a different command that reuses an id still runs.
+
+    With a directory configured each result is also written to its own file,
+    so duplicates are still recognised after an agent restart. Outputs are
+    cut to max_output characters to keep memory bounded.
+    """
+
+    def __init__(self, directory=None, max_entries=None, ttl=None, max_output=None):
+        if directory is None:
+            directory = os.getenv('RESULT_CACHE_DIR', '')
+        if max_entries is None:
+            max_entries = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', 500))
+        if ttl is None:
+            ttl = float(os.getenv('RESULT_CACHE_TTL', 3600))
+        if max_output is None:
+            max_output = int(os.getenv('RESULT_CACHE_MAX_OUTPUT', 65536))
+
+        self.store = JsonStore(directory, 'cached result')  # Empty directory keeps the cache in memory only
+        self.max_entries = max(0, max_entries)  # 0 turns the cache off
+        self.ttl = ttl
+        self.max_output = max(0, max_output)
+        self.entries = OrderedDict()  # commandId -> (stored_at, fingerprint, message)
+        self.running = set()  # (commandId, fingerprint) being executed right now
+        self._load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _load(self):
+        entries = []
+        for entry in self.store.load():
+            try:
+                entries.append((entry['storedAt'], entry.get('fingerprint'), entry['message']))
+            except (KeyError, TypeError) as e:
+                print(f"⚠ Dropping malformed cached result: {e}")
+        for stored_at, fingerprint, message in sorted(entries, key=lambda entry: entry[0]):
+            self.entries[message['commandId']] = (stored_at, fingerprint, message)
+        self._trim()
+
+    def _evict(self, command_id):
+        self.entries.pop(command_id, None)
+        self.store.delete(command_id)
+
+    def _trim(self):
+        expired_before = time.time() - self.ttl
+        # Least recently used first, get() checks expiry for anything left behind
+        while self.entries:
+            command_id, (stored_at, _, _) = next(iter(self.entries.items()))
+            if stored_at >= expired_before and len(self.entries) <= self.max_entries:
+                break
+            self._evict(command_id)
+
+    def get(self, command_id, fingerprint):
+        """Cached result message for this command_id and command, or None"""
+        entry = self.entries.get(command_id)
+        if entry is None:
+            return None
+        stored_at, stored_fingerprint, message = entry
+        if time.time() - stored_at > self.ttl:
+            self._evict(command_id)
+            return None
+        if stored_fingerprint != fingerprint:
+            return None  # Same id, different command
+        self.entries.move_to_end(command_id)
+        return message
+
+    def start(self, command_id, fingerprint):
+        """Mark the command as running, returns False if it already is"""
+        if (command_id, fingerprint) in self.running:
+            return False
+        self.running.add((command_id, fingerprint))
+        return True
+
+    def _clip(self, message):
+        output = message.get('output')
+        if isinstance(output, str) and len(output) > self.max_output:
+            return dict(message, output=output[:self.max_output] + '\n[output truncated]')
+        return message
+
+    def finish(self, command_id, fingerprint):
+        """The run is over, whether or not it produced a result"""
+        self.running.discard((command_id, fingerprint))
+
+    def add(self, message, fingerprint):
+        """Keep a result message for answering later deliveries of the same command"""
+        if not self.max_entries:
+            return
+        command_id = message['commandId']
+        message = self._clip(message)
+        if 'results' in message:
+            # batch_result: clip each command's output
+            message = dict(message, results=[self._clip(result) for result in message['results']])
+
+        stored_at = time.time()
+        self.entries.pop(command_id, None)
+        self.entries[command_id] = (stored_at, fingerprint, message)
+        self.store.save(command_id, {'storedAt': stored_at, 'fingerprint': fingerprint, 'message': message})
+        self._trim()
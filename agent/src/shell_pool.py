@@ -0,0 +1,237 @@
+"""
+Persistent shell session pool
+Runs commands in long-lived shells instead of spawning a new shell per
+command, framing each command with sentinel markers to recover its output
+and exit code
+"""
+import asyncio
+import locale
+import os
+import platform
+import tempfile
+import time
+import uuid
+
+from executor import decode_output, kill_process_tree
+
+READ_SIZE = 65536
+
+
+class BashProfile:
+    """Framing for bash (Linux/macOS)"""
+
+    argv = ['bash', '--noprofile', '--norc']
+
+    def prepare(self, command, marker):
+        """What frame() runs for command, bash takes it as typed"""
+        return command
+
+    def cleanup(self, prepared):
+        pass
+
+    def frame(self, command, start, end):
+        # Subshell keeps cd/export from leaking into later commands and
+        # /dev/null stops the command from reading our framing off stdin
+        return (
+            f"printf '%s\\n' {start}; printf '%s\\n' {start} >&2\n"
+            f"(\n{command}\n) < /dev/null\n"
+            f"printf '%s %d\\n' {end} $?; printf '%s\\n' {end} >&2\n"
+        )
+
+
+class CmdProfile:
+    """Framing for cmd.exe (Windows)"""
+
+    argv = ['cmd.exe', '/Q', '/D', '/K']
+
+    def prepare(self, command, marker):
+        """Write command to a batch file, so the prompt never parses it
+
+        The session calls the file, which parses the command once, multi-line
+        or not. setlocal works inside a batch file and ends with it, taking
+        the command's cd and set along. Like any batch file, for-loop
+        variables need %% there.
+        """
+        path = os.path.join(tempfile.gettempdir(), f"agent_{marker}.cmd")
+        with open(path, 'w', encoding=locale.getpreferredencoding(False), errors='replace', newline='\r\n') as f:
+            f.write(f"@setlocal\n{command}\n")
+        return path
+
+    def cleanup(self, prepared):
+        try:
+            os.remove(prepared)
+        except OSError:
+            pass
+
+    def frame(self, command, start, end):
+        # command is the batch file from prepare(); %^errorlevel% is only
+        # expanded when call re-parses the line
+        return (
+            f"echo {start}& echo {start} 1>&2\r\n"
+            f"call \"{command}\" < nul\r\n"
+            f"call echo {end} %^errorlevel%& echo {end} 1>&2\r\n"
+        )
+
+
+def session_env(prefix='SHELL_POOL_ENV_'):
+    """Agent environment plus SHELL_POOL_ENV_<NAME>=value overrides, None when there are none"""
+    overrides = {
+        name[len(prefix):]: value for name, value in os.environ.items()
+        if name.startswith(prefix) and len(name) > len(prefix)
+    }
+    if not overrides:
+        return None  # Sessions inherit the agent's environment
+    return {**os.environ, **overrides}
+
+
+def default_profile():
+    return CmdProfile() if platform.system() == 'Windows' else BashProfile()
+
+
+class ShellSession:
+    """One long-lived shell process"""
+
+    def __init__(self, profile, cwd=None, env=None):
+        self.profile = profile
+        self.cwd = cwd
+        self.env = env
+        self.proc = None
+        self.commands_run = 0
+        self.last_used = time.monotonic()
+
+    @property
+    def alive(self):
+        return self.proc is not None and self.proc.returncode is None
+
+    async def start(self):
+        self.proc = await asyncio.create_subprocess_exec(
+            *self.profile.argv,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=self.cwd,
+            env=self.env
+        )
+
+    async def close(self):
+        if self.proc is None:
+            return
+        if self.proc.returncode is None:
+            await asyncio.to_thread(kill_process_tree, self.proc.pid)
+            await self.proc.wait()
+        self.proc = None
+
+    async def run(self, command):
+        """Run one command, returns (returncode, stdout bytes, stderr bytes)"""
+        marker = uuid.uuid4().hex
+        start = f"__AGENT_START_{marker}__".encode()
+        end = f"__AGENT_END_{marker}__".encode()
+
+        prepared = await asyncio.to_thread(self.profile.prepare, command, marker)
+        try:
+            self.proc.stdin.write(self.profile.frame(prepared, start.decode(), end.decode()).encode())
+            await self.proc.stdin.drain()
+
+            (stdout, tail), (stderr, _) = await asyncio.gather(
+                self._read_frame(self.proc.stdout, start, end),
+                self._read_frame(self.proc.stderr, start, end)
+            )
+        finally:
+            self.profile.cleanup(prepared)
+        self.commands_run += 1
+        self.last_used = time.monotonic()
+
+        try:
+            returncode = int(tail.split()[0])
+        except (IndexError, ValueError):
+            returncode = -1
+        return returncode, stdout, stderr
+
+    async def _read_frame(self, reader, start, end):
+        """Read up to the end marker, returns (output, rest of the end line)"""
+        buffer = bytearray()
+        while True:
+            end_at = buffer.find(end)
+            if end_at != -1:
+                line_end = buffer.find(b'\n', end_at)
+                if line_end != -1:
+                    break
+            data = await reader.read(READ_SIZE)
+            if not data:
+                raise ConnectionError('Shell session exited')
+            buffer += data
+
+        # Anything before the start marker is leftover prompt noise
+        start_at = buffer.find(start)
+        output_from = buffer.find(b'\n', start_at) + 1 if start_at != -1 else 0
+        output = bytes(buffer[output_from:end_at])
+        tail = bytes(buffer[end_at + len(end):line_end])
+        return output, tail.decode(errors='replace')
+
+
+class ShellPool:
+    """Pool of shell sessions, recycled after max_commands or idle_timeout"""
+
+    def __init__(self, size=None, profile=None, cwd=None, env=None, max_commands=None, idle_timeout=None):
+        if size is None:
+            size = int(os.getenv('MAX_CONCURRENT_COMMANDS', 4))
+        if cwd is None:
+            cwd = os.getenv('SHELL_POOL_CWD') or None
+        if env is None:
+            env = session_env()
+        if max_commands is None:
+            max_commands = int(os.getenv('SHELL_POOL_MAX_COMMANDS', 100))
+        if idle_timeout is None:
+            idle_timeout = float(os.getenv('SHELL_POOL_IDLE_SECONDS', 300))
+
+        self.size = max(1, size)
+        self.profile = profile or default_profile()
+        self.cwd = cwd
+        self.env = env
+        self.max_commands = max_commands
+        self.idle_timeout = idle_timeout
+        self._idle = []
+        self._slots = asyncio.Semaphore(self.size)
+
+    async def _acquire(self):
+        await self._slots.acquire()
+        now = time.monotonic()
+        while self._idle:
+            session = self._idle.pop()
+            if session.alive and now - session.last_used < self.idle_timeout:
+                return session
+            await session.close()
+
+        session = ShellSession(self.profile, self.cwd, self.env)
+        try:
+            await session.start()
+        except BaseException:
+            self._slots.release()
+            raise
+        return session
+
+    async def _release(self, session, healthy):
+        if healthy and session.alive and session.commands_run < self.max_commands:
+            self._idle.append(session)
+        else:
+            await session.close()
+        self._slots.release()
+
+    async def run(self, command, timeout=None):
+        """Run a command in a pooled shell, returns (returncode, stdout, stderr) as text
+
+        A command that times out or is cancelled takes its session down with it.
+        """
+        session = await self._acquire()
+        healthy = False
+        try:
+            returncode, stdout, stderr = await asyncio.wait_for(session.run(command), timeout=timeout)
+            healthy = True
+            return returncode, decode_output(stdout), decode_output(stderr)
+        finally:
+            await self._release(session, healthy)
+
+    async def close(self):
+        """Close every idle session"""
+        while self._idle:
+            await self._idle.pop().close()
@@ -1,50 +1,211 @@
 """
 System information collection module
 Provides structured data about the agent's system
+
+The inventory is split into sections that are cached with their own TTL
+and collected on a worker pool with a timeout, so a slow mount or service
+query can't hang the whole collection.
 """
+import os
 import platform
 import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import psutil
 import subprocess
+from telemetry import sampler
+from processes import process_tracker, get_rank_keys
+from metrics import metrics
+
+# Seconds each section stays fresh, None means it never changes while running
+SECTION_TTLS = {
+    'static': None,
+    'memory': 5,
+    'disks': 60,
+    'network': 300,
+    'processes': 10,
+    'services': 60
+}
+
+_section_pool = ThreadPoolExecutor(max_workers=len(SECTION_TTLS), thread_name_prefix='inventory')
+_mount_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='inventory-mount')
+_lock = threading.Lock()
+_cache = {}      # section -> (collected_at, data)
+_in_flight = {}  # section or mountpoint -> future still running
+
+
+def collect_static():
+    """Facts that don't change while the agent runs"""
+    hostname = socket.gethostname()
+    return {
+        'hostname': hostname,
+        'platform': platform.system(),
+        'platform_release': platform.release(),
+        'platform_version': platform.version(),
+        'architecture': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': psutil.cpu_count()
+    }
+
+
+def collect_memory():
+    """Memory usage"""
+    memory = psutil.virtual_memory()
+    return {
+        'total': memory.total,
+        'available': memory.available,
+        'percent': memory.percent
+    }
+
+
+def _submit_once(pool, key, fn, *args):
+    """Submit fn unless an earlier call for key is still stuck running"""
+    with _lock:
+        future = _in_flight.get(key)
+        if future is None or future.done():
+            future = pool.submit(fn, *args)
+            _in_flight[key] = future
+        return future
+
+
+def collect_disks():
+    """Disk usage per partition, each mount gets its own timeout"""
+    partitions = psutil.disk_partitions()
+    futures = [
+        (partition, _submit_once(_mount_pool, f"mount:{partition.mountpoint}", psutil.disk_usage, partition.mountpoint))
+        for partition in partitions
+    ]
+    deadline = time.monotonic() + int(os.getenv('INVENTORY_MOUNT_TIMEOUT_MS', 2000)) / 1000
+
+    disks = []
+    for partition, future in futures:
+        entry = {'device': partition.device, 'mountpoint': partition.mountpoint}
+        try:
+            usage = future.result(timeout=max(deadline - time.monotonic(), 0))
+            entry.update({
+                'total': usage.total,
+                'used': usage.used,
+                'free': usage.free,
+                'percent': usage.percent
+            })
+        except FutureTimeoutError:
+            entry['error'] = 'timed out'
+        except Exception as e:
+            entry['error'] = str(e)
+        disks.append(entry)
+    return disks
+
+
+def collect_network():
+    """Network identity"""
+    hostname = socket.gethostname()
+    return {
+        'hostname': hostname,
+        'ip': socket.gethostbyname(hostname)
+    }
+
+
+def collect_processes():
+    """Top processes by CPU and memory"""
+    return get_top_processes()
+
+
+def collect_services():
+    """Windows services, None on other platforms"""
+    if platform.system() != 'Windows':
+        return None
+    return get_windows_services()
 
-def get_system_info():
-    """Collect comprehensive system information"""
+
+SECTION_COLLECTORS = {
+    'static': collect_static,
+    'memory': collect_memory,
+    'disks': collect_disks,
+    'network': collect_network,
+    'processes': collect_processes,
+    'services': collect_services
+}
+
+
+def get_sections(sections=None, max_age=None):
+    """Collect inventory sections, reusing cached ones that are still fresh
+
+    max_age overrides the section TTLs (0 forces a fresh collection).
+    A section that times out falls back to its last cached value. Returns
+    (sections, errors), errors holding a message for each section that
+    failed and was never collected.
+    """
+    if sections is None:
+        sections = list(SECTION_COLLECTORS)
+
+    now = time.monotonic()
+    results = {}
+    errors = {}
+    futures = {}
+    for name in sections:
+        if name not in SECTION_COLLECTORS:
+            continue
+
+        ttl = SECTION_TTLS[name] if max_age is None else max_age
+        with _lock:
+            cached = _cache.get(name)
+        if cached and (ttl is None or now - cached[0] < ttl):
+            results[name] = cached[1]
+        else:
+            futures[name] = _submit_once(_section_pool, name, SECTION_COLLECTORS[name])
+
+    deadline = time.monotonic() + int(os.getenv('INVENTORY_SECTION_TIMEOUT_MS', 10000)) / 1000
+    for name, future in futures.items():
+        try:
+            data = future.result(timeout=max(deadline - time.monotonic(), 0))
+            with _lock:
+                _cache[name] = (time.monotonic(), data)
+            results[name] = data
+        except Exception as e:
+            with _lock:
+                cached = _cache.get(name)
+            if cached:
+                results[name] = cached[1]
+            else:
+                errors[name] = 'timed out' if isinstance(e, FutureTimeoutError) else str(e)
+
+    return results, errors
+
+
+def get_system_info(sections=None, max_age=None):
+    """Collect system information
+
+    Returns the full inventory by default, or only the requested sections
+    (static, memory, disks, network, processes, services).
+    """
     try:
-        info = {
-            'hostname': socket.gethostname(),
-            'platform': platform.system(),
-            'platform_release': platform.release(),
-            'platform_version': platform.version(),
-            'architecture': platform.machine(),
-            'processor': platform.processor(),
-            'cpu_count': psutil.cpu_count(),
-            'cpu_percent': psutil.cpu_percent(interval=1),
-            'memory': {
-                'total': psutil.virtual_memory().total,
-                'available': psutil.virtual_memory().available,
-                'percent': psutil.virtual_memory().percent
-            },
-            'disk': [{
-                'device': partition.device,
-                'mountpoint': partition.mountpoint,
-                'total': psutil.disk_usage(partition.mountpoint).total,
-                'used': psutil.disk_usage(partition.mountpoint).used,
-                'free': psutil.disk_usage(partition.mountpoint).free,
-                'percent': psutil.disk_usage(partition.mountpoint).percent
-            } for partition in psutil.disk_partitions()],
-            'network': {
-                'hostname': socket.gethostname(),
-                'ip': socket.gethostbyname(socket.gethostname())
-            }
-        }
-        
+        with metrics.timer('system_info_seconds'):
+            data, errors = get_sections(sections, max_age)
+
+        info = {}
+        if 'static' in data:
+            info.update(data['static'])
+        info['cpu_percent'] = sampler.latest()['cpu_percent']
+        if 'memory' in data:
+            info['memory'] = data['memory']
+        if 'disks' in data:
+            info['disk'] = data['disks']
+        if 'network' in data:
+            info['network'] = data['network']
+
         # Add running services (Windows only)
-        if platform.system() == 'Windows':
-            info['services'] = get_windows_services()
-        
+        if data.get('services') is not None:
+            info['services'] = data['services']
+
         # Add top processes by CPU/Memory
-        info['top_processes'] = get_top_processes()
-        
+        if 'processes' in data:
+            info['top_processes'] = data['processes']
+
+        # Sections that could not be collected, by name, instead of in place of their data
+        if errors:
+            info['errors'] = errors
+
         return info
     except Exception as e:
         return {'error': str(e)}
@@ -82,40 +243,18 @@ def get_windows_services():
     except Exception as e:
         return [{'error': str(e)}]
 
-def get_top_processes(limit=10):
-    """Get top processes by CPU and memory usage"""
+def get_top_processes(limit=None, keys=None):
+    """Get top processes by CPU and memory usage (plus TOP_PROCESSES_KEYS)"""
     try:
-        processes = []
-        for proc in psutil.process_iter(['pid', 'name', 'cpu_percent', 'memory_percent']):
-            try:
-                processes.append({
-                    'pid': proc.info['pid'],
-                    'name': proc.info['name'],
-                    'cpu': proc.info['cpu_percent'] or 0,
-                    'memory': proc.info['memory_percent'] or 0
-                })
-            except (psutil.NoSuchProcess, psutil.AccessDenied):
-                pass
-        
-        # Sort by CPU usage
-        processes.sort(key=lambda x: x['cpu'], reverse=True)
-        top_cpu = processes[:limit]
-        
-        # Sort by memory usage
-        processes.sort(key=lambda x: x['memory'], reverse=True)
-        top_memory = processes[:limit]
-        
-        return {
-            'by_cpu': top_cpu,
-            'by_memory': top_memory
-        }
+        if limit is None:
+            limit = int(os.getenv('TOP_PROCESSES_LIMIT', 10))
+        if keys is None:
+            keys = get_rank_keys()
+        return process_tracker.top(limit, keys)
     except Exception as e:
         return {'error': str(e)}
 
 def get_quick_stats():
-    """Get quick performance stats"""
-    return {
-        'cpu_percent': psutil.cpu_percent(interval=1),
-        'memory_percent': psutil.virtual_memory().percent,
-        'disk_percent': psutil.disk_usage('/').percent if platform.system() != 'Windows' else psutil.disk_usage('C:\\').percent
-    }
+    """Get quick performance stats from the background sampler"""
+    with metrics.timer('quick_stats_seconds'):
+        return sampler.latest()
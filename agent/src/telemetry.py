@@ -0,0 +1,97 @@
+"""
+Background telemetry sampler
+Measures CPU, memory and disk usage on its own thread so readers on the
+event loop only ever copy the latest sample
+"""
+import os
+import platform
+import threading
+import time
+
+import psutil
+
+from history import StatsHistory
+
+
+def get_system_disk():
+    """Get the mountpoint used for the headline disk usage figure"""
+    if platform.system() == 'Windows':
+        return os.getenv('SystemDrive', 'C:') + '\\'
+    return '/'
+
+
+class TelemetrySampler:
+    """Samples quick stats every interval seconds on a daemon thread"""
+
+    def __init__(self, interval=None):
+        self.interval = interval
+        self.disk_path = get_system_disk()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._latest = None
+        self._latest_time = 0.0
+        self.history = None  # StatsHistory of every sample, set up in start()
+
+    def start(self):
+        """Start sampling, safe to call more than once"""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            # Read config here, the shared sampler is built before .env is loaded
+            if self.interval is None:
+                self.interval = int(os.getenv('TELEMETRY_INTERVAL_MS', 1000)) / 1000
+            self.interval = max(self.interval, 0.1)
+            if self.history is None and os.getenv('STATS_HISTORY', 'true').lower() == 'true':
+                self.history = StatsHistory()
+            # Prime the counter, cpu_percent(None) measures since the previous call
+            psutil.cpu_percent(interval=None)
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='telemetry-sampler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the sampling thread"""
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"⚠ Telemetry sample failed: {e}")
+
+    def sample(self):
+        """Take a sample now and make it the latest one"""
+        stats = {
+            'cpu_percent': psutil.cpu_percent(interval=None),
+            'memory_percent': psutil.virtual_memory().percent,
+            'disk_percent': psutil.disk_usage(self.disk_path).percent
+        }
+        now = time.time()
+        with self._lock:
+            self._latest = stats
+            self._latest_time = now
+        if self.history is not None:
+            self.history.add(now, stats)
+        return stats
+
+    def latest(self):
+        """Get a copy of the latest sample without blocking"""
+        with self._lock:
+            stats = self._latest
+        if stats is None:
+            # Nothing sampled yet, one non-blocking sample is still cheap
+            self.start()
+            stats = self.sample()
+        return dict(stats)
+
+    @property
+    def age(self):
+        """Seconds since the latest sample was taken"""
+        with self._lock:
+            return time.time() - self._latest_time if self._latest_time else None
+
+
+# Shared sampler for the whole agent
+sampler = TelemetrySampler()
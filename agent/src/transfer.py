@@ -0,0 +1,302 @@
+"""
+Chunked file transfer
+Moves files between the server and the agent in fixed-size chunks with a
+SHA-256 per chunk and per file. Reads go into one reused buffer and at most
+a window of unacknowledged chunks is in flight, so memory stays bounded
+whatever the file size. Transfers resume from an offset after reconnect.
+"""
+import asyncio
+import base64
+import hashlib
+import os
+
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def encode_chunk(chunk, binary):
+    """Raw bytes for binary wire encodings, base64 text for JSON"""
+    return bytes(chunk) if binary else base64.b64encode(chunk).decode('ascii')
+
+
+def decode_chunk(data):
+    return bytes(data) if isinstance(data, (bytes, bytearray)) else base64.b64decode(data)
+
+
+def hash_file(f, file_hash, length, buffer):
+    """Feed the first `length` bytes of f into file_hash, returns the bytes read"""
+    view = memoryview(buffer)
+    f.seek(0)
+    done = 0
+    while done < length:
+        n = f.readinto(view[:min(len(buffer), length - done)])
+        if not n:
+            break
+        file_hash.update(view[:n])
+        done += n
+    return done
+
+
+class _Download:
+    """Agent -> server transfer; the server acks offsets to open the window"""
+
+    def __init__(self, offset):
+        self.acked = offset
+        self.acked_event = asyncio.Event()
+        self.task = None
+
+    def ack(self, offset):
+        self.acked = max(self.acked, offset)
+        self.acked_event.set()
+
+    async def wait_for_window(self, position, window_bytes, timeout):
+        while position - self.acked >= window_bytes:
+            self.acked_event.clear()
+            await asyncio.wait_for(self.acked_event.wait(), timeout=timeout)
+
+
+class _Upload:
+    """Server -> agent transfer, written to <path>.part until complete"""
+
+    def __init__(self, path, size, sha256):
+        self.path = path
+        self.part_path = f"{path}.part"
+        self.size = size
+        self.sha256 = sha256
+        self.file = None
+        self.offset = 0
+        self.lock = asyncio.Lock()  # Chunks are handled in separate tasks, keep them in order
+
+    def open(self):
+        # Resume from whatever an earlier attempt left behind
+        mode = 'r+b' if os.path.exists(self.part_path) else 'w+b'
+        self.file = open(self.part_path, mode)
+        self.offset = self.file.seek(0, os.SEEK_END)
+        if self.offset > self.size:
+            self.file.truncate(0)
+            self.offset = self.file.seek(0)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class FileTransfers:
+    """Handles file_get/file_put and their chunk, ack and end messages"""
+
+    def __init__(self, send, chunk_size=None, window=None, ack_timeout=None):
+        if chunk_size is None:
+            chunk_size = int(os.getenv('FILE_CHUNK_SIZE', 256 * 1024))
+        if window is None:
+            window = int(os.getenv('FILE_WINDOW', 8))
+        if ack_timeout is None:
+            ack_timeout = float(os.getenv('FILE_ACK_TIMEOUT', 60))
+
+        self.send = send  # async send(message) on the current connection
+        self.chunk_size = min(max(chunk_size, 1024), MAX_CHUNK_SIZE)
+        self.window = max(window, 1)
+        self.ack_timeout = ack_timeout
+        self.binary = False  # Set when the wire encoding carries raw bytes
+        self.downloads = {}  # transferId -> _Download
+        self.uploads = {}  # transferId -> _Upload
+
+    def reset(self):
+        """Connection lost: stop sending, keep partial uploads on disk for resume"""
+        for download in self.downloads.values():
+            if download.task:
+                download.task.cancel()
+        for upload in self.uploads.values():
+            upload.close()
+
+    async def error(self, transfer_id, message):
+        print(f"✗ Transfer {transfer_id}: {message}")
+        await self.send({'type': 'file_error', 'transferId': transfer_id, 'error': message})
+
+    # ----- file_get: agent -> server -----
+
+    async def handle_get(self, data):
+        transfer_id = data['transferId']
+        offset = int(data.get('offset') or 0)
+        chunk_size = min(int(data.get('chunkSize') or self.chunk_size), MAX_CHUNK_SIZE)
+        window = int(data.get('window') or self.window)
+
+        previous = self.downloads.get(transfer_id)
+        if previous and previous.task:
+            previous.task.cancel()
+        download = _Download(offset)
+        download.task = asyncio.current_task()
+        self.downloads[transfer_id] = download
+
+        try:
+            await self._send_file(transfer_id, data['path'], offset, chunk_size, window, data.get('mtime'), download)
+        except asyncio.TimeoutError:
+            await self.error(transfer_id, 'Timed out waiting for acknowledgement')
+        except OSError as e:
+            await self.error(transfer_id, str(e))
+        finally:
+            if self.downloads.get(transfer_id) is download:
+                del self.downloads[transfer_id]
+
+    async def _send_file(self, transfer_id, path, offset, chunk_size, window, expected_mtime, download):
+        stat = await asyncio.to_thread(os.stat, path)
+        if expected_mtime is not None and expected_mtime != stat.st_mtime:
+            raise OSError(f"{path} changed since the transfer started")
+        if offset > stat.st_size:
+            raise OSError(f"Offset {offset} is past the end of {path}")
+        size = stat.st_size  # A file that grows while we read is sent as it was
+
+        print(f"→ Sending {path} ({size} bytes) from offset {offset}")
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        file_hash = hashlib.sha256()
+
+        with open(path, 'rb', buffering=0) as f:
+            # The file hash covers the whole file, including what was sent before a resume
+            if offset:
+                await asyncio.to_thread(hash_file, f, file_hash, offset, buffer)
+            f.seek(offset)
+
+            await self.send({
+                'type': 'file_meta',
+                'transferId': transfer_id,
+                'path': path,
+                'size': size,
+                'mtime': stat.st_mtime,
+                'offset': offset,
+                'chunkSize': chunk_size
+            })
+
+            def read_chunk(limit):
+                n = f.readinto(view[:limit])
+                chunk = view[:n]
+                file_hash.update(chunk)
+                return n, hashlib.sha256(chunk).hexdigest(), encode_chunk(chunk, self.binary)
+
+            position = offset
+            while position < size:
+                await download.wait_for_window(position, window * chunk_size, self.ack_timeout)
+                n, chunk_hash, payload = await asyncio.to_thread(read_chunk, min(chunk_size, size - position))
+                if not n:
+                    raise OSError(f"{path} was truncated during the transfer")
+                await self.send({
+                    'type': 'file_chunk',
+                    'transferId': transfer_id,
+                    'offset': position,
+                    'data': payload,
+                    'sha256': chunk_hash
+                })
+                position += n
+
+        await self.send({
+            'type': 'file_end',
+            'transferId': transfer_id,
+            'size': size,
+            'sha256': file_hash.hexdigest()
+        })
+        print(f"✓ Sent {path}")
+
+    def handle_ack(self, data):
+        download = self.downloads.get(data.get('transferId'))
+        if download:
+            download.ack(int(data.get('offset') or 0))
+
+    def cancel(self, transfer_id):
+        download = self.downloads.get(transfer_id)
+        if download and download.task:
+            download.task.cancel()
+            return True
+        upload = self.uploads.pop(transfer_id, None)
+        if upload:
+            upload.close()
+            return True
+        return False
+
+    # ----- file_put: server -> agent -----
+
+    async def handle_put(self, data):
+        transfer_id = data['transferId']
+        previous = self.uploads.get(transfer_id)
+        if previous:
+            previous.close()
+
+        upload = _Upload(data['path'], int(data['size']), data.get('sha256'))
+        try:
+            await asyncio.to_thread(upload.open)
+        except OSError as e:
+            await self.error(transfer_id, str(e))
+            return
+        self.uploads[transfer_id] = upload
+
+        print(f"→ Receiving {upload.path} ({upload.size} bytes) from offset {upload.offset}")
+        await self.send({'type': 'file_put_ready', 'transferId': transfer_id, 'offset': upload.offset})
+
+    async def handle_chunk(self, data):
+        transfer_id = data.get('transferId')
+        upload = self.uploads.get(transfer_id)
+        if upload is None:
+            await self.error(transfer_id, 'Unknown transfer')
+            return
+
+        async with upload.lock:
+            if upload.file is None:
+                return
+            if int(data.get('offset', -1)) != upload.offset:
+                # Out of step, ask the server to resend from where we are
+                await self.send({'type': 'file_ack', 'transferId': transfer_id, 'offset': upload.offset, 'resend': True})
+                return
+
+            chunk = decode_chunk(data['data'])
+            if data.get('sha256') and hashlib.sha256(chunk).hexdigest() != data['sha256']:
+                await self.error(transfer_id, f"Chunk at offset {upload.offset} failed its hash check")
+                return
+
+            try:
+                await asyncio.to_thread(upload.file.write, chunk)
+            except OSError as e:
+                await self.error(transfer_id, str(e))
+                return
+            upload.offset += len(chunk)
+            await self.send({'type': 'file_ack', 'transferId': transfer_id, 'offset': upload.offset})
+
+    async def handle_end(self, data):
+        transfer_id = data.get('transferId')
+        upload = self.uploads.get(transfer_id)
+        if upload is None:
+            await self.error(transfer_id, 'Unknown transfer')
+            return
+
+        async with upload.lock:
+            if upload.file is None:
+                # Closed by a reset or cancel while this message waited for the lock
+                await self.error(transfer_id, 'Transfer was interrupted, start it again to resume')
+                return
+            if upload.offset != upload.size:
+                await self.error(transfer_id, f"Expected {upload.size} bytes, have {upload.offset}")
+                return
+
+            def verify():
+                file_hash = hashlib.sha256()
+                upload.file.flush()
+                hash_file(upload.file, file_hash, upload.size, bytearray(self.chunk_size))
+                upload.close()
+                return file_hash.hexdigest()
+
+            try:
+                digest = await asyncio.to_thread(verify)
+                del self.uploads[transfer_id]
+                if upload.sha256 and digest != upload.sha256:
+                    await asyncio.to_thread(os.remove, upload.part_path)
+                    await self.error(transfer_id, 'File hash mismatch, partial file discarded')
+                    return
+                await asyncio.to_thread(os.replace, upload.part_path, upload.path)
+            except OSError as e:
+                await self.error(transfer_id, str(e))
+                return
+
+            print(f"✓ Received {upload.path}")
+            await self.send({
+                'type': 'file_put_done',
+                'transferId': transfer_id,
+                'size': upload.size,
+                'sha256': digest
+            })
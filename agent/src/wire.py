@@ -0,0 +1,95 @@
+"""
+Wire encoding for agent messages
+Negotiates a compact encoding and per-message compression with the server,
+falling back to plain JSON text frames for servers that don't support it
+
+Binary frames start with one header byte: the low bits name the encoding
+and the high bit marks a zlib-compressed payload.
+"""
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:  # Optional, JSON always works
+    msgpack = None
+
+ENCODING_IDS = {'json': 0x00, 'msgpack': 0x01}
+ENCODING_NAMES = {value: key for key, value in ENCODING_IDS.items()}
+ZLIB_FLAG = 0x80
+
+
+def available_encodings():
+    """Encodings this agent can speak, preferred first"""
+    encodings = []
+    if msgpack is not None:
+        encodings.append('msgpack')
+    encodings.append('json')
+    return encodings
+
+
+def _dumps(message, encoding):
+    if encoding == 'msgpack':
+        return msgpack.packb(message, use_bin_type=True)
+    return json.dumps(message, separators=(',', ':')).encode('utf-8')
+
+
+def _loads(payload, encoding):
+    if encoding == 'msgpack':
+        return msgpack.unpackb(payload, raw=False)
+    return json.loads(payload)
+
+
+class WireCodec:
+    """Encodes outgoing and decodes incoming messages"""
+
+    def __init__(self, encoding='json', compression=None, threshold=1024, level=6):
+        if encoding not in ENCODING_IDS or (encoding == 'msgpack' and msgpack is None):
+            encoding = 'json'
+        self.encoding = encoding
+        self.compression = compression if compression == 'zlib' else None
+        self.threshold = threshold
+        self.level = level
+
+    @property
+    def is_legacy(self):
+        """Plain JSON text frames, what servers without negotiation expect"""
+        return self.encoding == 'json' and self.compression is None
+
+    def encode(self, message):
+        """Encode a message as a text (legacy) or binary frame"""
+        if self.is_legacy:
+            return json.dumps(message)
+
+        payload = _dumps(message, self.encoding)
+        header = ENCODING_IDS[self.encoding]
+        if self.compression == 'zlib' and len(payload) >= self.threshold:
+            payload = zlib.compress(payload, self.level)
+            header |= ZLIB_FLAG
+        return bytes([header]) + payload
+
+    def decode(self, frame):
+        """Decode a text or binary frame"""
+        if isinstance(frame, str):
+            return json.loads(frame)
+
+        header, payload = frame[0], frame[1:]
+        if header & ZLIB_FLAG:
+            payload = zlib.decompress(payload)
+        encoding = ENCODING_NAMES.get(header & ~ZLIB_FLAG)
+        if encoding is None:
+            raise ValueError(f"Unknown wire encoding {header:#x}")
+        return _loads(payload, encoding)
+
+
+def handshake_headers():
+    """Headers offering our encodings and compression to the server"""
+    return {
+        'X-Agent-Encodings': ','.join(available_encodings()),
+        'X-Agent-Compression': 'zlib'
+    }
+
+
+def codec_from_hello(hello, threshold=1024):
+    """Build the codec the server picked in its hello message"""
+    return WireCodec(hello.get('encoding', 'json'), hello.get('compression'), threshold)
@@ -0,0 +1,57 @@
+// UDP beacon responder for agent discovery
+// Agents broadcast/multicast { type: 'discover', nonce } to BEACON_PORT and
+// rank the answers by load, so they find the server in one round trip
+// instead of port scanning the subnet.
+import dgram from 'dgram';
+import os from 'os';
+
+const PROTOCOL_VERSION = 1;
+const DEFAULT_GROUP = '239.255.77.77';
+
+// 1-minute load average per CPU, null (unknown) on Windows where Node reports 0
+function hostLoad() {
+  if (process.platform === 'win32') {
+    return null;
+  }
+  return Number((os.loadavg()[0] / (os.cpus().length || 1)).toFixed(3));
+}
+
+// describe() returns what to announce: scheme/port (or a full url) and load hints
+export function startBeacon(describe, logger, {
+  port = parseInt(process.env.BEACON_PORT) || 3001,
+  group = process.env.BEACON_GROUP ?? DEFAULT_GROUP
+} = {}) {
+  const socket = dgram.createSocket({ type: 'udp4', reuseAddr: true });
+
+  socket.on('message', (data, rinfo) => {
+    let query;
+    try {
+      query = JSON.parse(data.toString());
+    } catch {
+      return;
+    }
+    if (query?.type !== 'discover') {
+      return;
+    }
+    const reply = { type: 'beacon', version: PROTOCOL_VERSION, nonce: query.nonce, load: hostLoad(), ...describe() };
+    socket.send(JSON.stringify(reply), rinfo.port, rinfo.address);
+  });
+
+  socket.on('error', error => {
+    logger.warn(`⚠ Beacon responder stopped: ${error.message}`);
+    socket.close();
+  });
+
+  socket.bind(port, () => {
+    if (group) {
+      try {
+        socket.addMembership(group);
+      } catch (error) {
+        logger.warn(`⚠ Could not join multicast group ${group}, answering broadcasts only: ${error.message}`);
+      }
+    }
+    logger.info(`✓ Discovery beacon on udp/${port}`);
+  });
+
+  return socket;
+}
@@ -0,0 +1,56 @@
+// Delta-encoded snapshot streams from agents (heartbeat, system_info)
+
+function applyPatch(snapshot, patch) {
+  let result = structuredClone(snapshot);
+
+  for (const [path, value] of patch.set || []) {
+    if (path.length === 0) {
+      result = structuredClone(value);
+      continue;
+    }
+    let target = result;
+    for (const key of path.slice(0, -1)) {
+      target = target[key];
+    }
+    target[path[path.length - 1]] = structuredClone(value);
+  }
+
+  for (const path of patch.unset || []) {
+    let target = result;
+    for (const key of path.slice(0, -1)) {
+      target = target[key];
+    }
+    delete target[path[path.length - 1]];
+  }
+
+  return result;
+}
+
+// Per-connection state: the last snapshot applied for each stream
+export class DeltaTracker {
+  constructor() {
+    this.streams = new Map();
+  }
+
+  // Full snapshot with a version, becomes the base for later deltas
+  setSnapshot(stream, version, data) {
+    this.streams.set(stream, { version, data });
+  }
+
+  // Returns the full snapshot, or null if the base doesn't match and a resync is needed
+  applyDelta(stream, base, version, patch) {
+    const current = this.streams.get(stream);
+    if (!current || current.version !== base) {
+      return null;
+    }
+
+    try {
+      const data = applyPatch(current.data, patch);
+      this.streams.set(stream, { version, data });
+      return data;
+    } catch (error) {
+      this.streams.delete(stream);
+      return null;
+    }
+  }
+}
@@ -2,6 +2,8 @@ import express from 'express';
 import http from 'http';
 import { WebSocketServer } from 'ws';
 import dotenv from 'dotenv';
+import os from 'os';
+import crypto from 'crypto';
 import { createLogger } from './logger.js';
 import { processPrompt } from './gemini.js';
 import { validateCommand } from './guardrails.js';
@@ -16,6 +18,10 @@ import {
 } from './auth.js';
 import { RateLimiter, createRateLimitMiddleware } from './ratelimit.js';
 import { createHttpsServer, getServerProtocol, getWebSocketProtocol } from './https-server.js';
+import { DeltaTracker } from './delta.js';
+import { transferManager, transferPath } from './transfer.js';
+import { negotiate, decodeFrame } from './wire.js';
+import { startBeacon } from './beacon.js';
 
 dotenv.config();
 
@@ -23,6 +29,11 @@ const app = express();
 const PORT = process.env.PORT || 3000;
 const logger = createLogger();
 
+// Agents dedupe redeliveries by id, so two commands sent in the same millisecond must differ
+function newCommandId(prefix, agentId) {
+  return `${prefix}-${agentId}-${Date.now()}-${crypto.randomBytes(3).toString('hex')}`;
+}
+
 // Create rate limiters
 const commandLimiter = new RateLimiter(10, 60000); // 10 commands per minute
 const apiLimiter = new RateLimiter(100, 60000);    // 100 API calls per minute
@@ -46,6 +57,17 @@ server.listen(PORT, () => {
   } else {
     logger.warn('⚠ Running without HTTPS/WSS - Set ENABLE_HTTPS=true for production');
   }
+  
+  // Answer agents' UDP discovery queries so they don't have to port scan
+  if (process.env.BEACON !== 'false') {
+    startBeacon(() => ({
+      scheme: wsProtocol,
+      port: Number(PORT),
+      url: process.env.BEACON_URL || undefined,
+      name: os.hostname(),
+      agents: agents.size
+    }), logger);
+  }
 });
 
 // ===== AUTHENTICATION ENDPOINTS =====
@@ -176,14 +198,28 @@ app.use('/api', authenticate);
 // Apply general rate limiting to all API endpoints
 app.use('/api', createRateLimitMiddleware(apiLimiter, (req) => req.user?.username || req.ip));
 
-const wss = new WebSocketServer({ server });
+// permessage-deflate is off by default in ws; agents fall back to per-message zlib without it
+const WS_PER_MESSAGE_DEFLATE = process.env.WS_PER_MESSAGE_DEFLATE === 'true';
+const wss = new WebSocketServer({
+  server,
+  perMessageDeflate: WS_PER_MESSAGE_DEFLATE ? { threshold: 1024 } : false
+});
 const agents = new Map();
+const MAX_STREAMED_OUTPUT = 1024 * 1024; // characters kept per streamed command
+// Heartbeat cadence pushed to agents on connect (optional), and how long silence means offline
+const AGENT_HEARTBEAT_INTERVAL = parseFloat(process.env.AGENT_HEARTBEAT_INTERVAL) || null;
+const AGENT_HEARTBEAT_MAX_INTERVAL = parseFloat(process.env.AGENT_HEARTBEAT_MAX_INTERVAL) || null;
+const OFFLINE_AFTER_SECONDS = Math.max(30, (AGENT_HEARTBEAT_MAX_INTERVAL || 0) * 1.5);
+// Message types that carry versioned snapshots, and the delta stream they belong to
+const DELTA_STREAMS = { heartbeat: 'heartbeat', agent_info: 'system_info', system_info: 'system_info' };
 
 wss.on('connection', (ws, req) => {
   const agentId = req.headers['x-agent-id'];
   const token = req.headers['x-agent-token'];
   const nickname = req.headers['x-agent-nickname'] || agentId;
   const tags = req.headers['x-agent-tags'] ? req.headers['x-agent-tags'].split(',').map(t => t.trim()) : [];
+  // Optional message types the agent understands (e.g. execute_batch); empty for older agents
+  const capabilities = req.headers['x-agent-capabilities'] ? req.headers['x-agent-capabilities'].split(',').map(c => c.trim()) : [];
 
   if (token !== process.env.AGENT_TOKEN) {
     ws.close(1008, 'Invalid token');
@@ -194,6 +230,7 @@ wss.on('connection', (ws, req) => {
     ws, 
     nickname,
     tags,
+    capabilities,
     systemInfo: null, 
     stats: null, 
     connectedAt: new Date(),
@@ -202,6 +239,23 @@ wss.on('connection', (ws, req) => {
   });
   logger.info(`Agent connected: ${nickname} (${agentId}) [${tags.join(', ')}]`);
   
+  // Tell agents that negotiate which wire format to use; older agents keep plain JSON
+  const hello = negotiate(req, WS_PER_MESSAGE_DEFLATE);
+  if (hello) {
+    ws.send(JSON.stringify(hello));
+  }
+  
+  if (AGENT_HEARTBEAT_INTERVAL || AGENT_HEARTBEAT_MAX_INTERVAL) {
+    ws.send(JSON.stringify({
+      type: 'set_heartbeat',
+      interval: AGENT_HEARTBEAT_INTERVAL,
+      maxInterval: AGENT_HEARTBEAT_MAX_INTERVAL
+    }));
+  }
+  
+  // Continue file transfers this agent was in the middle of
+  transferManager.resume(agentId, ws);
+  
   // Track activity
   activityFeed.add(agentId, 'connection', {
     nickname,
@@ -217,9 +271,61 @@ wss.on('connection', (ws, req) => {
     timestamp: new Date().toISOString()
   });
 
-  ws.on('message', async (data) => {
+  // Last applied snapshot per delta stream on this connection
+  const deltaTracker = new DeltaTracker();
+  
+  // Streamed command output, keyed by commandId until the final result arrives
+  const streamedOutputs = new Map();
+
+  ws.on('message', async (data, isBinary) => {
     try {
-      const message = JSON.parse(data);
+      let message = decodeFrame(data, isBinary);
+      
+      // File transfer chunks, acks and status
+      if (message.type?.startsWith('file_')) {
+        await transferManager.handleMessage(ws, message);
+        return;
+      }
+      
+      // Delta-encoded snapshots: rebuild the full snapshot, then handle it as usual
+      if (message.type === 'delta') {
+        const snapshot = deltaTracker.applyDelta(message.stream, message.base, message.version, message.patch);
+        if (!snapshot) {
+          ws.send(JSON.stringify({ type: 'resync', stream: message.stream }));
+          return;
+        }
+        ws.send(JSON.stringify({ type: 'delta_ack', stream: message.stream, version: message.version }));
+        message = { type: message.messageType, data: snapshot };
+      } else if (message.version !== undefined && DELTA_STREAMS[message.type]) {
+        deltaTracker.setSnapshot(DELTA_STREAMS[message.type], message.version, message.data);
+        ws.send(JSON.stringify({ type: 'delta_ack', stream: DELTA_STREAMS[message.type], version: message.version }));
+      }
+      
+      if (message.type === 'result_chunk') {
+        let stream = streamedOutputs.get(message.commandId);
+        if (!stream) {
+          stream = { stdout: '', stderr: '', truncated: false };
+          streamedOutputs.set(message.commandId, stream);
+        }
+        const key = message.stream === 'stderr' ? 'stderr' : 'stdout';
+        // Cap what we keep in memory, the agent may stream far more than history needs.
+        // Split results are a finished output sent in pieces and are kept whole
+        if (message.split || stream.stdout.length + stream.stderr.length < MAX_STREAMED_OUTPUT) {
+          stream[key] += message.data || '';
+        } else {
+          stream.truncated = true;
+        }
+        return;
+      }
+      
+      if (message.type === 'result' && message.streamed) {
+        const stream = streamedOutputs.get(message.commandId);
+        streamedOutputs.delete(message.commandId);
+        if (stream) {
+          message.output = [stream.stdout, stream.stderr].filter(Boolean).join('\n') +
+            (stream.truncated ? '\n[output truncated]' : '') + (message.output || '');
+        }
+      }
       
       if (message.type === 'result') {
         logger.info(`Command result from ${agentId}:`, message.output);
@@ -270,6 +376,62 @@ wss.on('connection', (ws, req) => {
             await commandQueue.markFailed(message.commandId, message.output || 'Command failed');
             logger.warn(`Queue command failed: ${message.commandId}`);
           }
+          
+          // Let the agent drop the result from its outbox
+          ws.send(JSON.stringify({ type: 'result_ack', commandId: message.commandId }));
+        }
+      } else if (message.type === 'batch_result') {
+        const results = message.results || [];
+        // Outputs the agent split into result_chunk pieces arrive under `${commandId}#${index}`
+        results.forEach((r, index) => {
+          if (r.streamed) {
+            const key = `${message.commandId}#${index}`;
+            const stream = streamedOutputs.get(key);
+            streamedOutputs.delete(key);
+            if (stream) {
+              r.output = stream.stdout + (r.output || '');
+            }
+            delete r.streamed;
+            delete r.chunks;
+          }
+        });
+        const failed = results.filter(r => !r.success).length;
+        logger.info(`Batch result from ${agentId}: ${message.batchId} (${results.length - failed}/${results.length} succeeded, ${message.durationMs}ms)`);
+        
+        // One history entry and one activity entry for the whole batch
+        const output = results.map(r =>
+          `$ ${r.command}\n` +
+          (r.skipped ? '[skipped] ' : `[exit ${r.returncode}, ${r.durationMs}ms]\n`) +
+          (r.output || '')
+        ).join('\n');
+        
+        activityFeed.add(agentId, 'command', {
+          command: `batch (${results.length} commands)`,
+          success: message.success,
+          output: output.substring(0, 200)
+        });
+        
+        commandHistory.addEntry({
+          agentId: agentId,
+          command: results.map(r => r.command).join('\n'),
+          success: message.success,
+          output,
+          commandId: message.batchId
+        });
+        
+        notificationManager.notify(
+          message.success ? NotificationChannels.COMMAND_EXECUTED : NotificationChannels.COMMAND_FAILED,
+          {
+            agentId,
+            command: results.map(r => r.command).join('; '),
+            commandId: message.batchId,
+            ...(message.success ? {} : { error: `${failed} of ${results.length} commands failed` }),
+            timestamp: new Date().toISOString()
+          }
+        );
+        
+        if (message.commandId) {
+          ws.send(JSON.stringify({ type: 'result_ack', commandId: message.commandId }));
         }
       } else if (message.type === 'agent_info') {
         // Store agent system info
@@ -280,7 +442,27 @@ wss.on('connection', (ws, req) => {
           logger.info(`Received system info from ${agentId}`);
         }
       } else if (message.type === 'system_info') {
+        // May be a subset of sections, merge over what we already have
+        const agent = agents.get(agentId);
+        if (agent) {
+          agent.systemInfo = { ...(agent.systemInfo || {}), ...message.data };
+          agent.lastSeen = new Date();
+        }
         logger.info(`System info from ${agentId}:`, message.data);
+      } else if (message.type === 'agent_metrics') {
+        const agent = agents.get(agentId);
+        if (agent) {
+          agent.metrics = message.data;
+          agent.metricsAt = new Date();
+          agent.lastSeen = new Date();
+        }
+      } else if (message.type === 'stats_history') {
+        const agent = agents.get(agentId);
+        if (agent) {
+          agent.statsHistory = message.data;
+          agent.statsHistoryAt = new Date();
+          agent.lastSeen = new Date();
+        }
       } else if (message.type === 'quick_stats') {
         const agent = agents.get(agentId);
         if (agent) {
@@ -303,6 +485,7 @@ wss.on('connection', (ws, req) => {
   ws.on('close', () => {
     const agent = agents.get(agentId);
     agents.delete(agentId);
+    transferManager.disconnected(agentId);
     logger.info(`Agent disconnected: ${agentId}`);
     
     // Send notification
@@ -350,7 +533,7 @@ app.post('/api/execute', createRateLimitMiddleware(commandLimiter, (req) => req.
     }
 
     // Generate unique command ID for tracking
-    const commandId = `cmd-${agentId}-${Date.now()}`;
+    const commandId = newCommandId('cmd', agentId);
     
     // Send to agent
     agentData.ws.send(JSON.stringify({
@@ -407,7 +590,7 @@ app.post('/api/execute-batch', createRateLimitMiddleware(commandLimiter, (req) =
     // Send to all target agents
     const results = targetAgents.map(({ id, data }) => {
       try {
-        const commandId = `cmd-${id}-${Date.now()}`;
+        const commandId = newCommandId('cmd', id);
         data.ws.send(JSON.stringify({
           type: 'execute',
           command: command,
@@ -436,7 +619,7 @@ app.get('/api/agents', (req, res) => {
   const now = new Date();
   const agentList = Array.from(agents.entries()).map(([id, data]) => {
     const secondsSinceLastSeen = (now - data.lastSeen) / 1000;
-    const status = secondsSinceLastSeen > 30 ? 'offline' : 'online';
+    const status = secondsSinceLastSeen > OFFLINE_AFTER_SECONDS ? 'offline' : 'online';
     
     return {
       id,
@@ -464,7 +647,7 @@ app.get('/api/agents/:agentId', authenticate, (req, res) => {
   
   const now = new Date();
   const secondsSinceLastSeen = (now - agentData.lastSeen) / 1000;
-  const status = secondsSinceLastSeen > 30 ? 'offline' : 'online';
+  const status = secondsSinceLastSeen > OFFLINE_AFTER_SECONDS ? 'offline' : 'online';
   
   res.json({
     id: agentId,
@@ -492,6 +675,22 @@ app.get('/api/activity', authenticate, (req, res) => {
   res.json({ activities });
 });
 
+// One line per stat from an agent's stats_history, for the analysis prompt
+function summarizeStatsHistory(history) {
+  if (!history?.timestamps?.length) {
+    return '';
+  }
+  const minutes = Math.round((history.timestamps[history.timestamps.length - 1] - history.timestamps[0] + history.resolution) / 60);
+  const lines = [['CPU', 'cpu_percent'], ['RAM', 'memory_percent'], ['Disk', 'disk_percent']]
+    .filter(([, field]) => history.series?.[field]?.avg?.length)
+    .map(([label, field]) => {
+      const { min, max, avg } = history.series[field];
+      const mean = avg.reduce((sum, value) => sum + value, 0) / avg.length;
+      return `- ${label}: avg ${mean.toFixed(1)}%, min ${Math.min(...min)}%, max ${Math.max(...max)}%`;
+    });
+  return `Usage over the last ${minutes} minutes (${history.resolution}s resolution):\n${lines.join('\n')}`;
+}
+
 // AI-powered system analysis
 app.post('/api/analyze', authenticate, async (req, res) => {
   const { agentId } = req.body;
@@ -522,6 +721,8 @@ ${systemInfo.top_processes.by_memory.slice(0, 5).map(p => `- ${p.name}: ${p.memo
 
 ${systemInfo.services ? `Running Services: ${systemInfo.services.filter(s => s.state === 'RUNNING').length} active` : ''}
 
+${summarizeStatsHistory(agentData.statsHistory)}
+
 Provide:
 1. Performance assessment (Good/Fair/Poor)
 2. Top 3 specific optimization suggestions with Windows commands
@@ -569,7 +770,141 @@ app.post('/api/agents/:agentId/refresh', (req, res) => {
     return res.status(404).json({ error: 'Agent not found' });
   }
   
-  agentData.ws.send(JSON.stringify({ type: 'get_system_info' }));
+  // Optional subset: static, memory, disks, network, processes, services
+  const sections = Array.isArray(req.body?.sections) ? req.body.sections : undefined;
+  agentData.ws.send(JSON.stringify({ type: 'get_system_info', sections, refresh: true }));
+  res.json({ success: true });
+});
+
+// Agent self-instrumentation from the last agent_metrics message
+app.get('/api/agents/:agentId/metrics', authenticate, (req, res) => {
+  const { agentId } = req.params;
+  const agentData = agents.get(agentId);
+  
+  if (!agentData) {
+    return res.status(404).json({ error: 'Agent not found' });
+  }
+  
+  res.json({ agentId, metrics: agentData.metrics || null, receivedAt: agentData.metricsAt || null });
+});
+
+// Ask the agent for fresh metrics; read them with GET once they arrive
+app.post('/api/agents/:agentId/metrics', authenticate, (req, res) => {
+  const { agentId } = req.params;
+  const agentData = agents.get(agentId);
+  
+  if (!agentData) {
+    return res.status(404).json({ error: 'Agent not found' });
+  }
+  
+  agentData.ws.send(JSON.stringify({ type: 'get_agent_metrics' }));
+  res.json({ success: true });
+});
+
+// Stats history from the last stats_history message
+app.get('/api/agents/:agentId/stats/history', authenticate, (req, res) => {
+  const { agentId } = req.params;
+  const agentData = agents.get(agentId);
+  
+  if (!agentData) {
+    return res.status(404).json({ error: 'Agent not found' });
+  }
+  
+  res.json({ agentId, history: agentData.statsHistory || null, receivedAt: agentData.statsHistoryAt || null });
+});
+
+// Ask the agent for a range of its stats history; read it with GET once it arrives
+app.post('/api/agents/:agentId/stats/history', authenticate, (req, res) => {
+  const { agentId } = req.params;
+  const agentData = agents.get(agentId);
+  
+  if (!agentData) {
+    return res.status(404).json({ error: 'Agent not found' });
+  }
+  
+  // start/end are unix seconds, the agent defaults to the last hour
+  const { start, end, resolution, maxPoints } = req.body || {};
+  agentData.ws.send(JSON.stringify({ type: 'get_stats_history', start, end, resolution, maxPoints }));
+  res.json({ success: true });
+});
+
+// ===== FILE TRANSFER ENDPOINTS =====
+
+// Pull a file off an agent into TRANSFER_DIR
+app.post('/api/agents/:agentId/files/get', authenticate, (req, res) => {
+  const { agentId } = req.params;
+  const { path: remotePath, saveAs } = req.body;
+  const agentData = agents.get(agentId);
+  
+  if (!agentData) {
+    return res.status(404).json({ error: 'Agent not found' });
+  }
+  if (!remotePath) {
+    return res.status(400).json({ error: 'Missing path' });
+  }
+  if (!agentData.capabilities?.includes('file_transfer')) {
+    return res.status(400).json({ error: 'Agent does not support file transfer' });
+  }
+  
+  try {
+    const transferId = transferManager.startGet(agentId, agentData.ws, remotePath, saveAs);
+    res.json({ success: true, transferId });
+  } catch (error) {
+    res.status(400).json({ error: error.message });
+  }
+});
+
+// Push a file from TRANSFER_DIR to an agent
+app.post('/api/agents/:agentId/files/put', authenticate, async (req, res) => {
+  const { agentId } = req.params;
+  const { source, path: remotePath } = req.body;
+  const agentData = agents.get(agentId);
+  
+  if (!agentData) {
+    return res.status(404).json({ error: 'Agent not found' });
+  }
+  if (!source || !remotePath) {
+    return res.status(400).json({ error: 'Missing source or path' });
+  }
+  if (!agentData.capabilities?.includes('file_transfer')) {
+    return res.status(400).json({ error: 'Agent does not support file transfer' });
+  }
+  
+  try {
+    const transferId = await transferManager.startPut(agentId, agentData.ws, source, remotePath);
+    res.json({ success: true, transferId });
+  } catch (error) {
+    res.status(400).json({ error: error.message });
+  }
+});
+
+app.get('/api/transfers', authenticate, (req, res) => {
+  res.json(transferManager.list(req.query.agentId));
+});
+
+app.get('/api/transfers/:transferId', authenticate, (req, res) => {
+  const transfer = transferManager.get(req.params.transferId);
+  if (!transfer) {
+    return res.status(404).json({ error: 'Transfer not found' });
+  }
+  res.json(transfer);
+});
+
+// Download a completed file_get
+app.get('/api/transfers/:transferId/file', authenticate, (req, res) => {
+  const transfer = transferManager.get(req.params.transferId);
+  if (!transfer || transfer.direction !== 'get' || transfer.status !== 'complete') {
+    return res.status(404).json({ error: 'No completed download for this transfer' });
+  }
+  res.download(transferPath(transfer.localPath));
+});
+
+app.delete('/api/transfers/:transferId', authenticate, (req, res) => {
+  const transfer = transferManager.get(req.params.transferId);
+  const agentData = transfer && agents.get(transfer.agentId);
+  if (!transferManager.cancel(req.params.transferId, agentData?.ws)) {
+    return res.status(404).json({ error: 'No active transfer with that id' });
+  }
   res.json({ success: true });
 });
 
@@ -611,10 +946,25 @@ taskScheduler.setExecuteCallback(async (agentId, commands) => {
     throw new Error('Agent not connected');
   }
 
-  // Execute commands sequentially
+  // Agents that support it run the whole task as one batch and send one result
+  if (agentData.capabilities?.includes('execute_batch')) {
+    const batchId = newCommandId('sched', agentId);
+    agentData.ws.send(JSON.stringify({
+      type: 'execute_batch',
+      batchId,
+      commands,
+      mode: 'sequential',
+      stopOnError: false,
+      requireConfirmation: false
+    }));
+    
+    return { success: true, output: [{ commands, batchId }] };
+  }
+
+  // Older agents: one execute per command
   const results = [];
   for (const cmd of commands) {
-    const commandId = `sched-${agentId}-${Date.now()}`;
+    const commandId = newCommandId('sched', agentId);
     
     agentData.ws.send(JSON.stringify({
       type: 'execute',
@@ -796,7 +1146,7 @@ app.post('/api/groups/:groupName/execute', async (req, res) => {
       }
       
       try {
-        const commandId = `cmd-${id}-${Date.now()}`;
+        const commandId = newCommandId('cmd', id);
         agentData.ws.send(JSON.stringify({
           type: 'execute',
           command,
@@ -1121,7 +1471,7 @@ app.post('/api/templates/execute', async (req, res) => {
       return res.status(403).json({ error: validation.reason });
     }
     
-    const commandId = `cmd-${agentId}-${Date.now()}`;
+    const commandId = newCommandId('cmd', agentId);
     agentData.ws.send(JSON.stringify({
       type: 'execute',
       command,
@@ -1144,7 +1494,7 @@ setInterval(() => {
   for (const [agentId, data] of agents.entries()) {
     const secondsSinceLastSeen = (now - data.lastSeen) / 1000;
     
-    if (secondsSinceLastSeen > 30 && data.status === 'online') {
+    if (secondsSinceLastSeen > OFFLINE_AFTER_SECONDS && data.status === 'online') {
       data.status = 'offline';
       logger.warn(`Agent went offline: ${data.nickname} (${agentId})`);
       
@@ -0,0 +1,341 @@
+// Chunked, resumable file transfers with agents
+// file_get pulls a file off an agent into TRANSFER_DIR, file_put pushes a file
+// from TRANSFER_DIR to an agent. Chunks carry a SHA-256 each, the whole file is
+// checked at the end, and at most `window` unacknowledged chunks are in flight.
+// Interrupted transfers resume from the last acknowledged offset when the
+// agent reconnects.
+import crypto from 'crypto';
+import fs from 'fs';
+import path from 'path';
+
+const TRANSFER_DIR = path.resolve(process.env.TRANSFER_DIR || './transfers');
+// Agents cap chunks at 4 MiB (MAX_CHUNK_SIZE) and size their frame limit for that
+const MAX_CHUNK_SIZE = 4 * 1024 * 1024;
+const CHUNK_SIZE = Math.min(parseInt(process.env.FILE_CHUNK_SIZE) || 256 * 1024, MAX_CHUNK_SIZE);
+const WINDOW = parseInt(process.env.FILE_WINDOW) || 8;
+
+function sha256(data) {
+  return crypto.createHash('sha256').update(data).digest('hex');
+}
+
+// Agents send base64 text over JSON and raw bytes over MessagePack
+function chunkBytes(data) {
+  return typeof data === 'string' ? Buffer.from(data, 'base64') : Buffer.from(data);
+}
+
+// Keep names given through the API inside TRANSFER_DIR
+export function transferPath(name) {
+  const resolved = path.resolve(TRANSFER_DIR, name);
+  if (!resolved.startsWith(TRANSFER_DIR + path.sep)) {
+    throw new Error('Path must stay inside the transfer directory');
+  }
+  return resolved;
+}
+
+function hashFile(filePath, length) {
+  return new Promise((resolve, reject) => {
+    const hash = crypto.createHash('sha256');
+    if (length === 0) {
+      return resolve(hash.digest('hex'));
+    }
+    fs.createReadStream(filePath, { start: 0, end: length - 1 })
+      .on('data', chunk => hash.update(chunk))
+      .on('end', () => resolve(hash.digest('hex')))
+      .on('error', reject);
+  });
+}
+
+class TransferManager {
+  constructor() {
+    this.transfers = new Map(); // transferId -> transfer state
+    fs.mkdirSync(TRANSFER_DIR, { recursive: true });
+  }
+
+  list(agentId = null) {
+    return [...this.transfers.values()]
+      .filter(t => !agentId || t.agentId === agentId)
+      .map(t => this.describe(t));
+  }
+
+  get(transferId) {
+    const transfer = this.transfers.get(transferId);
+    return transfer ? this.describe(transfer) : null;
+  }
+
+  describe(t) {
+    return {
+      transferId: t.transferId,
+      agentId: t.agentId,
+      direction: t.direction,
+      remotePath: t.remotePath,
+      localPath: path.relative(TRANSFER_DIR, t.localPath),
+      size: t.size,
+      transferred: t.offset,
+      status: t.status,
+      error: t.error || null,
+      sha256: t.sha256 || null,
+      startedAt: t.startedAt,
+      finishedAt: t.finishedAt || null
+    };
+  }
+
+  // Pull remotePath off the agent into TRANSFER_DIR/localName
+  startGet(agentId, ws, remotePath, localName) {
+    const transferId = `xfer-${agentId}-${Date.now()}-${crypto.randomBytes(3).toString('hex')}`;
+    const localPath = transferPath(localName || `${agentId}/${path.basename(remotePath.replace(/\\/g, '/'))}`);
+    fs.mkdirSync(path.dirname(localPath), { recursive: true });
+
+    const transfer = {
+      transferId, agentId, direction: 'get', remotePath, localPath,
+      partPath: `${localPath}.part`, size: null, mtime: null, offset: 0,
+      writes: Promise.resolve(), status: 'pending', startedAt: new Date()
+    };
+    fs.writeFileSync(transfer.partPath, '');
+    this.transfers.set(transferId, transfer);
+    this.requestGet(transfer, ws);
+    return transferId;
+  }
+
+  requestGet(transfer, ws) {
+    transfer.status = 'active';
+    ws.send(JSON.stringify({
+      type: 'file_get',
+      transferId: transfer.transferId,
+      path: transfer.remotePath,
+      offset: transfer.offset,
+      // Resumes only continue if the file is unchanged
+      mtime: transfer.mtime ?? undefined,
+      chunkSize: CHUNK_SIZE,
+      window: WINDOW
+    }));
+  }
+
+  // Push TRANSFER_DIR/localName to remotePath on the agent
+  async startPut(agentId, ws, localName, remotePath) {
+    const localPath = transferPath(localName);
+    const stat = await fs.promises.stat(localPath);
+    const transferId = `xfer-${agentId}-${Date.now()}-${crypto.randomBytes(3).toString('hex')}`;
+
+    const transfer = {
+      transferId, agentId, direction: 'put', remotePath, localPath,
+      size: stat.size, offset: 0, sent: 0, status: 'pending', startedAt: new Date(),
+      sha256: await hashFile(localPath, stat.size)
+    };
+    this.transfers.set(transferId, transfer);
+    this.requestPut(transfer, ws);
+    return transferId;
+  }
+
+  requestPut(transfer, ws) {
+    transfer.status = 'active';
+    transfer.endSent = false;
+    ws.send(JSON.stringify({
+      type: 'file_put',
+      transferId: transfer.transferId,
+      path: transfer.remotePath,
+      size: transfer.size,
+      sha256: transfer.sha256
+    }));
+  }
+
+  // Agent reconnected: pick up its unfinished transfers where they stopped
+  resume(agentId, ws) {
+    for (const transfer of this.transfers.values()) {
+      if (transfer.agentId !== agentId || !['active', 'interrupted'].includes(transfer.status)) {
+        continue;
+      }
+      if (transfer.direction === 'get') {
+        this.requestGet(transfer, ws);
+      } else {
+        this.requestPut(transfer, ws);
+      }
+    }
+  }
+
+  disconnected(agentId) {
+    for (const transfer of this.transfers.values()) {
+      if (transfer.agentId === agentId && transfer.status === 'active') {
+        transfer.status = 'interrupted';
+        transfer.ws = null;
+      }
+    }
+  }
+
+  cancel(transferId, ws) {
+    const transfer = this.transfers.get(transferId);
+    if (!transfer || ['complete', 'failed', 'cancelled'].includes(transfer.status)) {
+      return false;
+    }
+    ws?.send(JSON.stringify({ type: 'file_cancel', transferId }));
+    this.fail(transfer, 'Cancelled', 'cancelled');
+    return true;
+  }
+
+  fail(transfer, error, status = 'failed') {
+    if (['complete', 'failed', 'cancelled'].includes(transfer.status)) {
+      return;
+    }
+    transfer.status = status;
+    transfer.error = error;
+    transfer.finishedAt = new Date();
+    if (transfer.direction === 'get') {
+      fs.rm(transfer.partPath, { force: true }, () => {});
+    }
+  }
+
+  // Returns true if the message was a transfer message
+  async handleMessage(ws, message) {
+    const transfer = this.transfers.get(message.transferId);
+    switch (message.type) {
+      case 'file_meta':
+        if (transfer) {
+          transfer.size = message.size;
+          transfer.mtime = message.mtime;
+        }
+        return true;
+      case 'file_chunk':
+        if (transfer) {
+          await this.receiveChunk(transfer, ws, message);
+        }
+        return true;
+      case 'file_end':
+        if (transfer) {
+          await this.finishGet(transfer, message);
+        }
+        return true;
+      case 'file_put_ready':
+        if (transfer) {
+          transfer.offset = message.offset;
+          transfer.sent = message.offset;
+          transfer.ws = ws;
+          await this.sendChunks(transfer);
+        }
+        return true;
+      case 'file_ack':
+        if (transfer && transfer.direction === 'put') {
+          transfer.offset = message.offset;
+          if (message.resend) {
+            transfer.sent = message.offset;
+          }
+          await this.sendChunks(transfer);
+        }
+        return true;
+      case 'file_put_done':
+        if (transfer) {
+          transfer.status = 'complete';
+          transfer.offset = message.size;
+          transfer.finishedAt = new Date();
+        }
+        return true;
+      case 'file_error':
+        if (transfer) {
+          this.fail(transfer, message.error);
+        }
+        return true;
+      default:
+        return false;
+    }
+  }
+
+  async receiveChunk(transfer, ws, message) {
+    if (transfer.status !== 'active') {
+      return;
+    }
+    if (message.offset !== transfer.offset) {
+      // Duplicate or out of step, re-ack where we really are
+      ws.send(JSON.stringify({ type: 'file_ack', transferId: transfer.transferId, offset: transfer.offset }));
+      return;
+    }
+
+    const data = chunkBytes(message.data);
+    if (message.sha256 && sha256(data) !== message.sha256) {
+      ws.send(JSON.stringify({ type: 'file_cancel', transferId: transfer.transferId }));
+      this.fail(transfer, `Chunk at offset ${message.offset} failed its hash check`);
+      return;
+    }
+
+    // Advance before the write so chunks arriving meanwhile are checked against the
+    // new offset, and chain the appends so they land in order
+    transfer.offset += data.length;
+    const offset = transfer.offset;
+    transfer.writes = transfer.writes.then(() => fs.promises.appendFile(transfer.partPath, data));
+    try {
+      await transfer.writes;
+    } catch (error) {
+      ws.send(JSON.stringify({ type: 'file_cancel', transferId: transfer.transferId }));
+      this.fail(transfer, error.message);
+      return;
+    }
+    ws.send(JSON.stringify({ type: 'file_ack', transferId: transfer.transferId, offset }));
+  }
+
+  async finishGet(transfer, message) {
+    if (transfer.status !== 'active') {
+      return;
+    }
+    // Let appends still in flight land before checking the file
+    try {
+      await transfer.writes;
+    } catch (error) {
+      return; // receiveChunk has already failed the transfer
+    }
+    const digest = await hashFile(transfer.partPath, transfer.offset);
+    if (transfer.offset !== message.size || digest !== message.sha256) {
+      this.fail(transfer, 'File hash mismatch');
+      return;
+    }
+    await fs.promises.rename(transfer.partPath, transfer.localPath);
+    transfer.sha256 = digest;
+    transfer.status = 'complete';
+    transfer.finishedAt = new Date();
+  }
+
+  async sendChunks(transfer) {
+    if (transfer.status !== 'active' || !transfer.ws) {
+      return;
+    }
+    if (transfer.sending) {
+      // An ack arrived mid-loop, go round again once the loop is done
+      transfer.wake = true;
+      return;
+    }
+    transfer.sending = true;
+    transfer.wake = false;
+    const ws = transfer.ws;
+    try {
+      const handle = await fs.promises.open(transfer.localPath, 'r');
+      try {
+        while (transfer.status === 'active' && transfer.sent < transfer.size &&
+               transfer.sent - transfer.offset < WINDOW * CHUNK_SIZE) {
+          const length = Math.min(CHUNK_SIZE, transfer.size - transfer.sent);
+          const buffer = Buffer.allocUnsafe(length);
+          const { bytesRead } = await handle.read(buffer, 0, length, transfer.sent);
+          const chunk = buffer.subarray(0, bytesRead);
+          ws.send(JSON.stringify({
+            type: 'file_chunk',
+            transferId: transfer.transferId,
+            offset: transfer.sent,
+            data: chunk.toString('base64'),
+            sha256: sha256(chunk)
+          }));
+          transfer.sent += bytesRead;
+        }
+      } finally {
+        await handle.close();
+      }
+      if (transfer.offset >= transfer.size && !transfer.endSent) {
+        transfer.endSent = true;
+        ws.send(JSON.stringify({ type: 'file_end', transferId: transfer.transferId }));
+      }
+    } catch (error) {
+      this.fail(transfer, error.message);
+    } finally {
+      transfer.sending = false;
+    }
+    if (transfer.wake) {
+      await this.sendChunks(transfer);
+    }
+  }
+}
+
+export const transferManager = new TransferManager();
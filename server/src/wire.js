@@ -0,0 +1,65 @@
+// Wire format negotiation with agents
+// Agents offer encodings and compression in handshake headers; we answer with a
+// hello naming our pick. Binary frames start with one header byte: the low bits
+// name the encoding and the high bit marks a zlib-compressed payload.
+import zlib from 'zlib';
+
+// MessagePack is optional, JSON always works
+let msgpack = null;
+try {
+  msgpack = await import('@msgpack/msgpack');
+} catch (error) {
+  msgpack = null;
+}
+
+const ENCODINGS = { json: 0x00, msgpack: 0x01 };
+const ZLIB_FLAG = 0x80;
+
+export function supportedEncodings() {
+  return msgpack ? ['msgpack', 'json'] : ['json'];
+}
+
+// Returns the hello message for this agent, or null for agents that don't negotiate
+export function negotiate(req, perMessageDeflate) {
+  const offeredEncodings = req.headers['x-agent-encodings'];
+  if (!offeredEncodings) {
+    return null;
+  }
+
+  const offered = offeredEncodings.split(',').map(e => e.trim());
+  const encoding = offered.find(e => supportedEncodings().includes(e)) || 'json';
+
+  // No point compressing twice when permessage-deflate is active on the socket
+  const extensions = req.headers['sec-websocket-extensions'] || '';
+  const deflateActive = perMessageDeflate && extensions.includes('permessage-deflate');
+  const offeredCompression = (req.headers['x-agent-compression'] || '').split(',').map(c => c.trim());
+  const compression = !deflateActive && offeredCompression.includes('zlib') ? 'zlib' : null;
+
+  // resultAck: we confirm each result so agents can clear their outbox.
+  // splitBatch: batch_result outputs may arrive as result_chunk pieces
+  return { type: 'hello', encoding, compression, resultAck: true, splitBatch: true };
+}
+
+export function decodeFrame(data, isBinary) {
+  if (!isBinary) {
+    return JSON.parse(data);
+  }
+
+  const header = data[0];
+  let payload = data.subarray(1);
+  if (header & ZLIB_FLAG) {
+    payload = zlib.inflateSync(payload);
+  }
+
+  switch (header & ~ZLIB_FLAG) {
+    case ENCODINGS.json:
+      return JSON.parse(payload.toString('utf8'));
+    case ENCODINGS.msgpack:
+      if (!msgpack) {
+        throw new Error('Received MessagePack frame but @msgpack/msgpack is not installed');
+      }
+      return msgpack.decode(payload);
+    default:
+      throw new Error(`Unknown wire encoding 0x${header.toString(16)}`);
+  }
+}